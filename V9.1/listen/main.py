@@ -1,7 +1,15 @@
 import os
+import re
+import json
 import time
+import argparse
+import itertools
 import subprocess
 import threading
+from collections import deque
+import queue
+import sounddevice as sd
+import requests
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
 import tkinter as tk
@@ -9,37 +17,291 @@ from tkinter import messagebox
 from pystray import Icon, MenuItem, Menu
 from PIL import Image, ImageDraw
 
+SAMPLE_RATE = 24000  # 与服务端 AISHELL3 模型采样率一致
+BUFFER_SECONDS = 10  # 环形缓冲区可提前缓存的音频时长
+PREFETCH_COUNT = 3  # 播放当前片段时最多预读并解码的后续片段数
+PREFETCH_BYTES = 32 * 1024 * 1024  # 预解码 PCM 的内存预算
+STABLE_INTERVAL = 0.2  # 非原子写入的文件：大小在该间隔内不再变化才认为写完
+GAP_TIMEOUT = 3.0  # 缺失的片段超过该时间仍未到达则跳过
+JOB_IDLE_TIMEOUT = 10.0  # 没有收到结束事件时（文件夹模式），任务超过该时间没有新片段视为已结束
+SEGMENT_PATTERN = re.compile(r'^(?P<job>.+)_(?P<seq>\d{4})\.mp3$')  # 服务端片段命名：{name}_{i:04d}.mp3
+
+
+def decode_to_pcm(data):
+    """用 ffmpeg 把内存中的音频解码为单声道 16bit PCM（不打开音频设备）"""
+    result = subprocess.run(
+        ["ffmpeg", "-v", "quiet", "-i", "pipe:0",
+         "-f", "s16le", "-ac", "1", "-ar", str(SAMPLE_RATE), "-"],
+        input=data, stdout=subprocess.PIPE,
+        creationflags=subprocess.CREATE_NO_WINDOW  # 不显示命令行窗口
+    )
+    return result.stdout
+
+
+class PCMRingBuffer:
+    """固定容量的 PCM 环形缓冲区：解码线程写入，音频回调读取"""
+    def __init__(self, capacity):
+        self.buffer = bytearray(capacity)
+        self.capacity = capacity
+        self.read_pos = 0
+        self.size = 0
+        self.written = 0  # 累计写入字节数
+        self.consumed = 0  # 累计播放字节数
+        self.cond = threading.Condition()
+
+    def write(self, data):
+        """写入数据，缓冲区满时阻塞等待播放腾出空间"""
+        view = memoryview(data)
+        while len(view):
+            with self.cond:
+                while self.size == self.capacity:
+                    self.cond.wait()
+                n = min(len(view), self.capacity - self.size)
+                write_pos = (self.read_pos + self.size) % self.capacity
+                first = min(n, self.capacity - write_pos)
+                self.buffer[write_pos:write_pos + first] = view[:first]
+                self.buffer[:n - first] = view[first:n]
+                self.size += n
+                self.written += n
+            view = view[n:]
+
+    def read(self, length):
+        """读取 length 字节，不阻塞，数据不足的部分补静音"""
+        with self.cond:
+            n = min(length, self.size)
+            first = min(n, self.capacity - self.read_pos)
+            data = bytes(self.buffer[self.read_pos:self.read_pos + first]) + bytes(self.buffer[:n - first])
+            self.read_pos = (self.read_pos + n) % self.capacity
+            self.size -= n
+            self.consumed += n
+            self.cond.notify_all()
+        return data + bytes(length - n)
+
+
+class PCMPlayer:
+    """常驻的音频输出流：所有片段写入同一个环形缓冲区，句与句之间没有间隙"""
+    def __init__(self):
+        self.ring = PCMRingBuffer(SAMPLE_RATE * 2 * BUFFER_SECONDS)
+        self.markers = deque()  # (片段起始字节位置, 文件名, 到达时间)
+        self.started = queue.Queue()  # 音频回调中开始播放的片段，由报告线程打印
+        threading.Thread(target=self._report_worker, daemon=True).start()
+        self.stream = sd.RawOutputStream(
+            samplerate=SAMPLE_RATE, channels=1, dtype='int16', callback=self._callback
+        )
+        self.stream.start()
+
+    def _callback(self, outdata, frames, time_info, status):
+        outdata[:] = self.ring.read(len(outdata))
+        while self.markers and self.markers[0][0] <= self.ring.consumed:
+            self.started.put_nowait((self.markers.popleft(), time.time()))
+
+    def _report_worker(self):
+        while True:
+            (_, audio_file, arrived_at), started_at = self.started.get()
+            print(f"开始播放: {os.path.basename(audio_file)}，文件到达到出声 {(started_at - arrived_at) * 1000:.0f}ms")
+
+    def play(self, pcm, audio_file, arrived_at):
+        """把一个片段排到当前播放内容之后，返回时数据已进入缓冲区"""
+        self.markers.append((self.ring.written, audio_file, arrived_at))
+        self.ring.write(pcm)
+
+
+def is_temp_file(path):
+    """服务端写入中的临时文件（以 . 开头，写完后原子重命名）"""
+    return os.path.basename(path).startswith(".")
+
+
+def parse_segment(audio_file):
+    """返回 (任务标识, 片段序号)；不符合命名规则的文件视为只有一个片段的任务"""
+    directory, file_name = os.path.split(audio_file)
+    match = SEGMENT_PATTERN.match(file_name)
+    if not match:
+        return audio_file, 0
+    return os.path.join(directory, match.group('job')), int(match.group('seq'))
+
+
+class SegmentQueue:
+    """线程安全的播放队列
+
+    按任务到达顺序、任务内片段序号出队；片段 N 未到达前不会播放 N+1，
+    超过 GAP_TIMEOUT 仍缺失则跳过。服务端会同时生成多个任务，前一个任务结束（finish，
+    或 JOB_IDLE_TIMEOUT 内没有新片段）之前不播放后面的任务，两个任务的句子不会交替播放。
+    put/get 之间用条件变量唤醒，不轮询。
+    """
+    def __init__(self, gap_timeout=GAP_TIMEOUT, idle_timeout=JOB_IDLE_TIMEOUT):
+        self.gap_timeout = gap_timeout
+        self.idle_timeout = idle_timeout
+        self.cond = threading.Condition()
+        self.jobs = {}  # 任务标识 -> {"order", "next", "finished", "pending": {序号: (文件, 到达时间, 是否已写完)}}
+        self.order = itertools.count()
+
+    def put(self, audio_file, arrived_at=None, complete=True):
+        """complete=False 表示文件可能还在写入，播放前需要等待写完"""
+        job, seq = parse_segment(audio_file)
+        with self.cond:
+            state = self.jobs.get(job)
+            if state is None or seq < state["next"]:
+                # 新任务，或同名任务重新生成（序号回到前面）
+                self._prune()
+                state = self.jobs[job] = {"order": next(self.order), "next": 0, "finished": False, "pending": {}}
+            if seq in state["pending"]:
+                return
+            state["pending"][seq] = (audio_file, arrived_at or time.time(), complete)
+            state["updated"] = time.time()
+            self.cond.notify()
+
+    def finish(self, job):
+        """任务已结束（HTTP 模式下的 job-finished / job-cancelled / job-failed 事件），播完后可以开始下一个任务"""
+        with self.cond:
+            if job in self.jobs:
+                self.jobs[job]["finished"] = True
+                self.cond.notify()
+
+    def _prune(self, idle_seconds=3600):
+        """清理长时间没有新片段的任务状态"""
+        now = time.time()
+        for job in [job for job, state in self.jobs.items()
+                    if not state["pending"] and now - state["updated"] > idle_seconds]:
+            del self.jobs[job]
+
+    def _pop_ready(self):
+        """取出可播放的片段；没有时返回 (None, 最长等待秒数)"""
+        now = time.time()
+        for job, state in sorted(self.jobs.items(), key=lambda item: item[1]["order"]):
+            pending = state["pending"]
+            if not pending:
+                idle = now - state["updated"]
+                if state["finished"] or idle >= self.idle_timeout:
+                    continue
+                return None, self.idle_timeout - idle  # 任务还在生成，后面的任务等它结束
+            if state["next"] not in pending:
+                first = min(pending)
+                waited = now - min(item[1] for item in pending.values())
+                if waited < self.gap_timeout:
+                    return None, self.gap_timeout - waited
+                print(f"片段缺失，跳过: {job} {state['next']:04d}-{first - 1:04d}")
+                state["next"] = first
+            item = pending.pop(state["next"])
+            state["next"] += 1
+            return item, None
+        return None, None
+
+    def get(self):
+        """阻塞直到有可播放的片段，返回 (文件, 到达时间, 是否已写完)"""
+        with self.cond:
+            while True:
+                item, timeout = self._pop_ready()
+                if item:
+                    return item
+                self.cond.wait(timeout)
+
+
+def wait_until_complete(audio_file, timeout=30):
+    """等待文件写入完成（大小连续两次检查不变且非空），用于不走原子重命名的写入方"""
+    last_size, deadline = -1, time.time() + timeout
+    while time.time() < deadline:
+        try:
+            size = os.path.getsize(audio_file)
+        except OSError:
+            size = -1
+        if size > 0 and size == last_size:
+            return True
+        last_size = size
+        time.sleep(STABLE_INTERVAL)
+    return False
+
+
+def read_segment(audio_file):
+    """读取片段内容：本地/共享目录文件，或 HTTP 模式下服务端的片段 URL"""
+    if audio_file.startswith(("http://", "https://")):
+        response = requests.get(audio_file, timeout=10)
+        response.raise_for_status()
+        return response.content
+    with open(audio_file, "rb") as f:
+        return f.read()
+
+
+class Prefetcher:
+    """后台按播放顺序预读、预解码后续片段，最多 PREFETCH_COUNT 个且不超过内存预算
+
+    共享目录（SMB）上的读取在这里一次性完成，播放时只从内存取 PCM。
+    """
+    def __init__(self, source, count=PREFETCH_COUNT, budget=PREFETCH_BYTES):
+        self.source = source
+        self.count = count
+        self.budget = budget
+        self.ready = deque()  # (文件, 到达时间, PCM)
+        self.ready_bytes = 0
+        self.cond = threading.Condition()
+        threading.Thread(target=self._worker, daemon=True).start()
+
+    def _worker(self):
+        while True:
+            with self.cond:
+                while len(self.ready) >= self.count or self.ready_bytes >= self.budget:
+                    self.cond.wait()
+            audio_file, arrived_at, complete = self.source.get()
+            if not complete and not wait_until_complete(audio_file):
+                print(f"等待文件写入完成超时: {audio_file}")
+                continue
+            try:
+                data = read_segment(audio_file)
+            except (OSError, requests.RequestException) as e:
+                print(f"读取音频文件失败: {audio_file}, 原因: {e}")
+                continue
+            pcm = decode_to_pcm(data)
+            with self.cond:
+                self.ready.append((audio_file, arrived_at, pcm))
+                self.ready_bytes += len(pcm)
+                self.cond.notify_all()
+
+    def get(self):
+        """阻塞直到下一个片段解码完成，返回 (文件, 到达时间, PCM)"""
+        with self.cond:
+            while not self.ready:
+                self.cond.wait()
+            item = self.ready.popleft()
+            self.ready_bytes -= len(item[2])
+            self.cond.notify_all()
+        return item
+
+
 class AudioFileHandler(FileSystemEventHandler):
     def __init__(self):
-        self.file_queue = []
+        self.file_queue = SegmentQueue()
 
     def on_created(self, event):
-        if event.is_directory:
+        if event.is_directory or is_temp_file(event.src_path):
             return
         if event.src_path.endswith(".mp3"):
-            self.file_queue.append(event.src_path)
-            self.file_queue.sort()
+            # 直接创建的文件可能还在写入，播放前先等待写完
+            self.file_queue.put(event.src_path, time.time(), complete=False)
+
+    def on_moved(self, event):
+        # 服务端先写隐藏临时文件再重命名到位，重命名完成即表示文件已写完
+        if event.is_directory or is_temp_file(event.dest_path):
+            return
+        if event.dest_path.endswith(".mp3"):
+            self.file_queue.put(event.dest_path, time.time())
 
     def play_files_in_order(self):
+        player = PCMPlayer()
+        prefetcher = Prefetcher(self.file_queue)
         while True:
-            if self.file_queue:
-                audio_file = self.file_queue.pop(0)
-                print(f"播放音频文件: {audio_file}")
+            audio_file, arrived_at, pcm = prefetcher.get()
+            print(f"播放音频文件: {audio_file}")
 
-                # 使用 subprocess 运行 ffplay 并防止命令行窗口弹出
-                subprocess.run(
-                    ["ffplay", "-nodisp", "-autoexit", audio_file],
-                    creationflags=subprocess.CREATE_NO_WINDOW  # 不显示命令行窗口
-                )
-            else:
-                time.sleep(0.1)
+            # 写入常驻输出流的缓冲区，后续片段已在后台解码好
+            player.play(pcm, audio_file, arrived_at)
 
 
 def start_observer():
-    output_dir = os.getcwd()
+    # 服务端每个任务的片段写在 segments/<job_id>/ 下，需要递归监听
+    output_dir = os.path.join(os.getcwd(), "segments")
+    os.makedirs(output_dir, exist_ok=True)
     event_handler = AudioFileHandler()
     observer = Observer()
-    observer.schedule(event_handler, path=output_dir, recursive=False)
+    observer.schedule(event_handler, path=output_dir, recursive=True)
     observer.start()
     try:
         event_handler.play_files_in_order()
@@ -48,6 +310,40 @@ def start_observer():
     observer.join()
 
 
+def subscribe_segments(server, file_queue):
+    """通过服务端 /events（SSE）订阅新片段，断线后自动重连"""
+    while True:
+        try:
+            with requests.get(f"{server}/events", stream=True, timeout=(5, 60)) as response:
+                response.raise_for_status()
+                response.encoding = "utf-8"
+                print(f"已连接服务端: {server}")
+                event = None
+                for line in response.iter_lines(decode_unicode=True):
+                    if line.startswith("event:"):
+                        event = line[len("event:"):].strip()
+                    elif line.startswith("data:") and event == "segment-ready":
+                        payload = json.loads(line[len("data:"):])
+                        file_queue.put(server + payload["url"], time.time())
+                    elif line.startswith("data:") and event in ("job-finished", "job-cancelled", "job-failed"):
+                        payload = json.loads(line[len("data:"):])
+                        # 与 segment-ready 的 URL 按同样规则得到任务标识
+                        job, _ = parse_segment(f"{server}/segments/{payload['job_id']}/{payload['name']}_0000.mp3")
+                        file_queue.finish(job)
+                    elif not line:
+                        event = None
+        except requests.RequestException as e:
+            print(f"连接服务端失败: {e}，3秒后重试")
+        time.sleep(3)
+
+
+def start_http_client(server):
+    """HTTP 模式：不监听共享目录，直接从服务端拉取片段播放"""
+    event_handler = AudioFileHandler()
+    threading.Thread(target=subscribe_segments, args=(server.rstrip("/"), event_handler.file_queue), daemon=True).start()
+    event_handler.play_files_in_order()
+
+
 def create_tray_icon():
     def quit_program(icon, item):
         icon.stop()
@@ -64,5 +360,13 @@ def create_tray_icon():
 
 
 if __name__ == "__main__":
-    threading.Thread(target=start_observer, daemon=True).start()
+    parser = argparse.ArgumentParser(description="汉鑫软件播放程序")
+    parser.add_argument("--server", default=os.environ.get("HANXIN_SERVER"),
+                        help="服务端地址（如 http://127.0.0.1:8888），指定后通过 HTTP 拉取片段，不再监听当前目录")
+    args = parser.parse_args()
+
+    if args.server:
+        threading.Thread(target=start_http_client, args=(args.server,), daemon=True).start()
+    else:
+        threading.Thread(target=start_observer, daemon=True).start()
     create_tray_icon()
@@ -0,0 +1,197 @@
+"""HTTP 接口压测
+
+按泊松到达并发请求 /generate_audio，一部分任务中途 /stop_audio，完成后下载 /files/<name>.mp3，
+统计吞吐、p50/p95/p99 延迟、拒绝率和错误率。只依赖标准库。
+
+本机假引擎压测（不加载模型，结果可复现）：
+    python loadtest.py --spawn 预加载/app.py --rate 2 --duration 60
+或对已启动的服务：
+    TTS_BACKEND=fake python 预加载/app.py
+    python loadtest.py --server http://127.0.0.1:8888 --rate 2 --duration 60
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import random
+import argparse
+import threading
+import subprocess
+import urllib.error
+import urllib.request
+
+# 真实场景的文本长度分布：叫号/提示短句为主，夹杂业务说明和长公告
+LENGTH_MIX = [(0.6, 10, 40), (0.3, 50, 150), (0.1, 300, 800)]  # (占比, 最少字数, 最多字数)
+PHRASES = ["请{}号到{}号窗口办理业务", "欢迎光临", "请您耐心等待", "办理业务请携带身份证件",
+           "今天营业时间为上午九点至下午五点", "请保管好您的随身物品", "感谢您的配合", "下一位请准备"]
+
+
+def make_text(rng):
+    """按 LENGTH_MIX 生成一段中文文本"""
+    r, acc = rng.random(), 0.0
+    for share, low, high in LENGTH_MIX:
+        acc += share
+        if r <= acc:
+            break
+    target, parts = rng.randint(low, high), []
+    while sum(map(len, parts)) < target:
+        phrase = rng.choice(PHRASES)
+        parts.append(phrase.format(rng.randint(1, 20), rng.randint(1, 20)) + rng.choice("，，，。！"))
+    return "".join(parts)
+
+
+def request(method, url, body=None, timeout=30):
+    """返回 (状态码, 响应体, 耗时秒)，连接失败时状态码为 None"""
+    data = json.dumps(body).encode() if body is not None else None
+    req = urllib.request.Request(url, data=data, method=method, headers={"Content-Type": "application/json"})
+    start = time.perf_counter()
+    try:
+        with urllib.request.urlopen(req, timeout=timeout) as response:
+            return response.status, response.read(), time.perf_counter() - start
+    except urllib.error.HTTPError as e:
+        return e.code, e.read(), time.perf_counter() - start
+    except (urllib.error.URLError, OSError) as e:
+        return None, str(e).encode(), time.perf_counter() - start
+
+
+class Recorder:
+    """线程安全地收集各接口的延迟与结果"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latency = {}  # 指标 -> [秒]
+        self.counts = {}  # 结果 -> 次数
+        self.audio_seconds = 0.0
+
+    def add(self, metric, seconds):
+        with self.lock:
+            self.latency.setdefault(metric, []).append(seconds)
+
+    def count(self, outcome):
+        with self.lock:
+            self.counts[outcome] = self.counts.get(outcome, 0) + 1
+
+
+def percentile(values, q):
+    values = sorted(values)
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(round(q / 100 * (len(values) - 1))))]
+
+
+def run_job(server, rng, recorder, stop_ratio, poll_interval, job_timeout):
+    """提交一个任务并跟踪到结束：可能被拒绝（429）、中途中断或完成后下载"""
+    name = f"load_{uuid.uuid4().hex[:8]}"
+    status, body, elapsed = request("POST", f"{server}/generate_audio", {"name": name, "text": make_text(rng)})
+    recorder.add("submit", elapsed)
+    if status == 429:
+        recorder.count("rejected")
+        return
+    if status != 200:
+        recorder.count(f"submit_error_{status}")
+        return
+    recorder.count("accepted")
+    job_id = json.loads(body)["job_id"]
+    submitted = time.perf_counter()
+
+    stop_at = submitted + rng.uniform(0.2, 3.0) if rng.random() < stop_ratio else None
+    while time.perf_counter() - submitted < job_timeout:
+        if stop_at and time.perf_counter() >= stop_at:
+            status, _, elapsed = request("POST", f"{server}/stop_audio", {"job_id": job_id})
+            recorder.add("stop", elapsed)
+            recorder.count("stop_requested" if status == 200 else f"stop_error_{status}")
+            stop_at = None
+        status, body, _ = request("GET", f"{server}/jobs/{job_id}")
+        job = json.loads(body) if status == 200 else {}
+        if job.get("status") == "finished":
+            recorder.add("complete", time.perf_counter() - submitted)
+            with recorder.lock:
+                recorder.audio_seconds += job.get("duration") or 0.0
+            status, _, elapsed = request("GET", f"{server}{job['url']}")
+            recorder.add("download", elapsed)
+            recorder.count("finished" if status == 200 else f"download_error_{status}")
+            return
+        if job.get("status") in ("cancelled", "failed"):
+            recorder.count(job["status"])
+            return
+        time.sleep(poll_interval)
+    recorder.count("timeout")
+
+
+def spawn_server(app_path, port=8888):
+    """以假引擎启动本机服务，等到 /stats 可以访问"""
+    env = dict(os.environ, TTS_BACKEND="fake")
+    process = subprocess.Popen([sys.executable, os.path.basename(app_path)], cwd=os.path.dirname(app_path) or ".",
+                               env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    server = f"http://127.0.0.1:{port}"
+    for _ in range(120):
+        if request("GET", f"{server}/stats", timeout=1)[0] == 200:
+            return process, server
+        if process.poll() is not None:
+            raise RuntimeError(f"服务启动失败，返回码 {process.returncode}")
+        time.sleep(0.5)
+    process.kill()
+    raise RuntimeError("服务启动超时")
+
+
+def report(recorder, wall):
+    finished = recorder.counts.get("finished", 0)
+    total = sum(recorder.counts.get(key, 0) for key in ("accepted", "rejected")) + \
+        sum(count for key, count in recorder.counts.items() if key.startswith("submit_error"))
+    errors = sum(count for key, count in recorder.counts.items() if "error" in key or key in ("failed", "timeout"))
+    result = {
+        "wall_seconds": round(wall, 1),
+        "submitted": total,
+        "throughput_jobs_per_s": round(finished / wall, 3),
+        "audio_seconds_per_s": round(recorder.audio_seconds / wall, 2),
+        "rejection_rate": round(recorder.counts.get("rejected", 0) / total, 3) if total else None,
+        "error_rate": round(errors / total, 3) if total else None,
+        "counts": recorder.counts,
+        "latency_ms": {metric: {f"p{q}": round(percentile(values, q) * 1000, 1) for q in (50, 95, 99)}
+                       for metric, values in sorted(recorder.latency.items())},
+    }
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="/generate_audio 并发压测")
+    parser.add_argument("--server", default="http://127.0.0.1:8888")
+    parser.add_argument("--spawn", help="以假引擎（TTS_BACKEND=fake）启动指定的 app.py 后压测，结束后关闭")
+    parser.add_argument("--rate", type=float, default=1.0, help="平均到达率（任务/秒，泊松到达）")
+    parser.add_argument("--duration", type=float, default=30, help="持续提交的秒数")
+    parser.add_argument("--stop-ratio", type=float, default=0.05, help="中途调用 /stop_audio 的任务比例")
+    parser.add_argument("--poll", type=float, default=0.2, help="查询任务状态的间隔（秒）")
+    parser.add_argument("--job-timeout", type=float, default=600)
+    parser.add_argument("--seed", type=int, default=0, help="随机种子，相同种子生成相同的到达序列和文本")
+    parser.add_argument("--json", help="把结果另存为 JSON 文件")
+    args = parser.parse_args()
+
+    process, server = spawn_server(args.spawn) if args.spawn else (None, args.server.rstrip("/"))
+    rng, recorder, threads = random.Random(args.seed), Recorder(), []
+    start = time.perf_counter()
+    try:
+        next_arrival = start
+        while next_arrival - start < args.duration:
+            time.sleep(max(0.0, next_arrival - time.perf_counter()))
+            job_rng = random.Random(rng.random())  # 每个任务独立的随机数，线程调度不影响可复现性
+            thread = threading.Thread(target=run_job, args=(server, job_rng, recorder, args.stop_ratio,
+                                                            args.poll, args.job_timeout))
+            thread.start()
+            threads.append(thread)
+            next_arrival += rng.expovariate(args.rate)
+        for thread in threads:
+            thread.join()
+    finally:
+        if process:
+            process.terminate()
+            process.wait()
+
+    result = report(recorder, time.perf_counter() - start)
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,57 @@
-from flask import Flask, request, jsonify, send_from_directory
-from paddlespeech.cli.tts import TTSExecutor
+import time
+startup_begin = time.perf_counter()  # 启动报告的计时起点
+from flask import Flask, Response, request, jsonify, send_from_directory
 from flask_cors import CORS
-from pydub import AudioSegment
+import numpy as np
+import soundfile as sf
 import os
 import re
-import time
+import sys
+import hmac
+import math
+import json
+import queue
+import struct
+import pstats
+import hashlib
+import cProfile
+import importlib
+import functools
+import contextlib
+import collections
+import uuid
+import shutil
+import bisect
+import sqlite3
+import unicodedata
+import argparse
+import subprocess
 import threading
+import urllib.error
+import urllib.request
+from concurrent.futures import Future, ThreadPoolExecutor
+
+# paddlespeech / paddle / pydub 等重量级依赖在加载模型或第一次用到时才导入（lazy_import）
+startup_report = {
+    "strategy": "lazy",
+    "module_import": round(time.perf_counter() - startup_begin, 3),  # flask 等轻量依赖
+    "imports": {},  # 模块 -> 首次导入耗时（秒）
+    "model_load": {},  # 后端 -> 模型加载耗时
+    "warmup": {},  # 后端 -> 预热（第一次合成）耗时
+    "model_ready": {},  # 后端 -> 从启动到模型可用的时间
+    "ready": None,  # 从启动到开始监听端口的时间
+}
+
+def since_startup():
+    return round(time.perf_counter() - startup_begin, 3)
+
+def lazy_import(module):
+    """按需导入模块，首次导入的耗时记入启动报告"""
+    if module not in sys.modules:
+        start = time.perf_counter()
+        importlib.import_module(module)
+        startup_report["imports"][module] = round(time.perf_counter() - start, 3)
+    return sys.modules[module]
 
 app = Flask(__name__)
 CORS(app)  # 启用跨域支持
@@ -13,159 +59,2323 @@ CORS(app)  # 启用跨域支持
 output_dir = "/mnt"
 files_dir = os.path.join(output_dir, "files")  # 存放合并文件的目录
 os.makedirs(files_dir, exist_ok=True)  # 确保文件夹存在
+job_state_dir = os.path.join(output_dir, "job_state")  # 任务计划与进度，容器重启后据此续做
+segments_dir = os.path.join(output_dir, "segments")  # 每个任务一个工作目录 segments/<job_id>/，任务结束后异步删除
+os.makedirs(segments_dir, exist_ok=True)
+templates_path = os.path.join(output_dir, "templates.json")  # 已注册的播报模板
+profiles_dir = os.path.join(output_dir, "profiles")  # /admin/profile 的分析结果
+admin_token = os.environ.get("TTS_ADMIN_TOKEN")  # 管理接口令牌（请求头 X-Admin-Token），未设置时管理接口不可用
+segment_retention = float(os.environ.get("TTS_SEGMENT_RETENTION", 300))  # 任务结束后工作目录保留的秒数（留给播放端）
+
+# 推理后端：paddle（PaddleSpeech 动态图）、onnx（ONNX Runtime CPU）或 fake（压测用假引擎，不加载模型）
+# fake 只在服务本身以 TTS_BACKEND=fake 启动时可用，生产服务的请求不能选到假引擎
+default_backend = os.environ.get("TTS_BACKEND", "paddle")
+backends = ('paddle', 'onnx', 'fake') if default_backend == 'fake' else ('paddle', 'onnx')
+onnx_dir = os.environ.get("TTS_ONNX_DIR", "/mnt/models/onnx")  # export-onnx 导出目录
+cpu_threads = int(os.environ.get("TTS_CPU_THREADS", os.cpu_count() or 1))
+phrase_bank_path = os.environ.get("TTS_PHRASE_BANK", "/mnt/models/phrase_bank")  # 预渲染短语库（.pcm + .json）
+# 多进程/多 worker 共享的句子音频缓存：目录、容量上限（MB，0 为关闭）；更换模型文件后修改 TTS_MODEL_VERSION 使旧缓存失效
+segment_cache_dir = os.environ.get("TTS_SEGMENT_CACHE", os.path.join(output_dir, "cache"))
+segment_cache_mb = float(os.environ.get("TTS_SEGMENT_CACHE_MB", 1024))
+model_version = os.environ.get("TTS_MODEL_VERSION", "1")
+fake_rtf = float(os.environ.get("TTS_FAKE_RTF", 0.05))  # 假引擎模拟的实时率（合成耗时 / 音频时长）
+# 声码器：hifigan_aishell3（float）或 hifigan_aishell3_int8（ONNX INT8 量化，python app.py quantize-voc 生成）
+vocoders = ('hifigan_aishell3', 'hifigan_aishell3_int8')
+default_voc = os.environ.get("TTS_VOC", "hifigan_aishell3")
+# 流式声码器：每块 mel 帧数与两侧重叠的上下文帧数（HiFiGAN 每帧 12.5ms）
+voc_chunk_frames = int(os.environ.get("TTS_VOC_CHUNK", 40))
+voc_pad_frames = int(os.environ.get("TTS_VOC_PAD", 12))
+# 自动拆句：latency 模式首句短（尽快出声）、后续句长（摊薄单次调用开销）；throughput 模式统一用长句
+split_modes = ('latency', 'throughput')
+default_split_mode = os.environ.get("TTS_SPLIT_MODE", "latency")
+target_first_audio = float(os.environ.get("TTS_TARGET_FIRST_AUDIO", 0.8))  # 首句合成耗时目标（秒）
+target_call_overhead = 0.1  # 后续句中单次调用固定开销的占比上限
+split_min_length, split_default_length, split_max_length = 8, 30, 60
+# 并发任务数与声学模型跨任务批处理（收集窗口毫秒数 / 最大 batch）
+max_active_jobs = int(os.environ.get("TTS_MAX_JOBS", 4))
+batch_window_ms = float(os.environ.get("TTS_BATCH_WINDOW_MS", 10))
+batch_max_size = int(os.environ.get("TTS_BATCH_MAX", 8))
+# 文本前端预计算：线程数（0 为关闭，在模型锁内即时计算）、每个任务向后预取的句子数、所有任务合计最多预取的句子数
+frontend_workers = int(os.environ.get("TTS_FRONTEND_WORKERS", 2))
+frontend_lookahead = 32
+frontend_prefetch_limit = 4096
+# 准入控制：预计完成时间超过 latency_budget 秒时返回 429；capacity 为并发任务合起来相当于几路串行合成
+latency_budget = float(os.environ.get("TTS_LATENCY_BUDGET", 120))
+worker_capacity = float(os.environ.get("TTS_CAPACITY", 1.0))
+default_per_call, default_per_char = 0.05, 0.02  # 还没有实测样本时的合成耗时估计（秒）
+default_seconds_per_char = 0.25  # 还没有实测样本时每字的音频时长估计（秒）
+# 长文档模式：每次读取的文本块大小、无句末标点时强制拆句的缓冲长度、去重缓存的句子数
+document_read_size = 64 * 1024
+document_flush_length = 4096
+document_dedup_size = 64
+# 模板播报：槽位音频缓存条数、片段边界的交叉淡化时长、边界标点对应的停顿（秒）
+template_slot_cache_size = 256
+join_crossfade = 0.01
+pause_seconds = {'、': 0.1, '，': 0.15, ',': 0.15, '；': 0.2, ';': 0.2, '：': 0.2, ':': 0.2,
+                 '。': 0.3, '.': 0.3, '！': 0.3, '!': 0.3, '？': 0.3, '?': 0.3}
+phones_dict_path = '/mnt/models/fastspeech2_aishell3/phone_id_map.txt'
+speaker_dict_path = '/mnt/models/fastspeech2_aishell3/speaker_id_map.txt'
+
+deletion_queue = collections.deque()  # 等待删除的 (到期时间, 路径)
+jobs = {}  # job_id -> 任务状态（保留最近 max_job_history 个）
+max_job_history = 200
+event_subscribers = []  # 每个 /events 连接一个消息队列
+event_lock = threading.Lock()
+worker_pool = None  # 协调模式（serve --workers）下的 WorkerPool
+
+def onnx_session(path, threads=cpu_threads):
+    """创建 CPU 上的 ONNX Runtime 会话"""
+    ort = lazy_import("onnxruntime")
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"找不到ONNX模型: {path}，请先执行 python app.py export-onnx")
+    options = ort.SessionOptions()
+    options.intra_op_num_threads = threads
+    options.inter_op_num_threads = 1
+    options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+    options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    return ort.InferenceSession(path, sess_options=options, providers=['CPUExecutionProvider'])
+
+
+class OnnxVocoder:
+    """ONNX 声码器（float 或 INT8 量化）"""
+    def __init__(self, path, threads=cpu_threads):
+        self.sess = onnx_session(path, threads)
+        self.input = self.sess.get_inputs()[0].name  # logmel
+
+    def __call__(self, mel):
+        return self.sess.run(None, {self.input: mel.astype(np.float32)})[0].reshape(-1)
+
+
+class TTSBackend:
+    """推理后端基类：文本前端 -> FastSpeech2 -> HiFiGAN，调用方式与 TTSExecutor 一致"""
+    name = None
+    fs = 24000
+
+    def __init__(self):
+        self.lock = threading.Lock()  # 模型实例不是线程安全的
+        self.vocoders = {}  # 额外的 ONNX 声码器，按名称延迟加载
+
+    def get_phone_ids(self, text):
+        """文本前端：返回每个子句的 phone id 数组"""
+        raise NotImplementedError
+
+    def make_frontend(self):
+        """创建一个独立的文本前端（供前端线程使用，不占用模型锁），返回 文本 -> phone id 数组列表 的函数"""
+        frontend = lazy_import("paddlespeech.t2s.frontend.zh_frontend").Frontend(phone_vocab_path=phones_dict_path)
+        return lambda text: [ids.numpy() for ids in frontend.get_input_ids(text, merge_sentences=False)["phone_ids"]]
+
+    def acoustic(self, phone_ids, spk_id):
+        """声学模型：phone id -> mel"""
+        raise NotImplementedError
+
+    def acoustic_batch(self, batch):
+        """批量声学模型：batch 为 [(phone_ids, spk_id)]，默认逐条推理"""
+        return [self.acoustic(phone_ids, spk_id) for phone_ids, spk_id in batch]
+
+    def _vocode(self, mel):
+        """float 声码器 hifigan_aishell3：mel -> 波形"""
+        raise NotImplementedError
+
+    def vocode(self, mel, voc=None):
+        """声码器：mel -> 波形，voc 为声码器名称（默认 default_voc）"""
+        voc = voc or default_voc
+        if voc == 'hifigan_aishell3':
+            return self._vocode(mel)
+        if voc not in self.vocoders:
+            self.vocoders[voc] = OnnxVocoder(os.path.join(onnx_dir, f'{voc}.onnx'))
+        return self.vocoders[voc](mel)
+
+    def synthesize(self, text, spk_id=0, voc=None):
+        """合成整句，返回 float32 波形"""
+        with self.lock:
+            wavs = [self.vocode(self.acoustic(ids, spk_id), voc) for ids in self.get_phone_ids(text)]
+        if not wavs:
+            return np.zeros(0, dtype=np.float32)
+        return np.concatenate(wavs)
+
+    def vocode_stream(self, mel, voc=None, chunk_frames=voc_chunk_frames, pad_frames=voc_pad_frames):
+        """分块声码器：对带重叠上下文的 mel 块逐块生成波形，块边界做交叉淡化"""
+        total, tail = len(mel), None
+        for start in range(0, total, chunk_frames):
+            end = min(start + chunk_frames, total)
+            ctx_start, ctx_end = max(0, start - pad_frames), min(total, end + pad_frames)
+            with self.lock:
+                wav = self.vocode(mel[ctx_start:ctx_end], voc)
+            hop = len(wav) // (ctx_end - ctx_start)
+            offset = (start - ctx_start) * hop
+            body = wav[offset:offset + (end - start) * hop].copy()
+            if tail is not None:
+                n = min(len(tail), len(body))
+                ramp = np.linspace(0.0, 1.0, n, dtype=np.float32)
+                body[:n] = tail[:n] * (1 - ramp) + body[:n] * ramp
+            # 本块右侧上下文的前半段与下一块开头重叠，留作交叉淡化
+            tail = wav[offset + len(body):offset + len(body) + (ctx_end - end) * hop // 2]
+            yield body
+
+    def synthesize_stream(self, text, spk_id=0, voc=None):
+        """流式合成：声学模型逐子句输出 mel，声码器分块生成，逐段 yield 波形"""
+        with self.lock:
+            phone_ids = self.get_phone_ids(text)
+        for ids in phone_ids:
+            with self.lock:
+                mel = self.acoustic(ids, spk_id)
+            yield from self.vocode_stream(mel, voc)
+
+    def __call__(self, text, output, spk_id=0, voc=None, **kwargs):
+        """与 TTSExecutor 相同的调用方式（am/lang 等参数忽略），合成结果写入 output"""
+        sf.write(output, self.synthesize(text, spk_id, voc), samplerate=self.fs)
+        return output
+
+
+class PaddleTTSBackend(TTSBackend):
+    """PaddleSpeech TTSExecutor 后端"""
+    name = 'paddle'
+
+    def __init__(self, executor):
+        super().__init__()
+        self.executor = executor  # 已用模型路径初始化过的 TTSExecutor
+        self.fs = executor.am_config.fs
+        self.padded_batch = True  # 当前 PaddleSpeech 版本是否支持 padding 批量推理
+
+    def get_phone_ids(self, text):
+        input_ids = self.executor.frontend.get_input_ids(text, merge_sentences=False)
+        return [ids.numpy() for ids in input_ids["phone_ids"]]
+
+    def acoustic(self, phone_ids, spk_id):
+        import paddle
+        with paddle.no_grad():
+            mel = self.executor.am_inference(
+                paddle.to_tensor(phone_ids), spk_id=paddle.to_tensor(spk_id))
+        return mel.numpy()
+
+    def acoustic_batch(self, batch):
+        """padding 成一个 batch 做一次 FastSpeech2 推理，当前版本不支持时退回逐条推理"""
+        if len(batch) == 1 or not self.padded_batch:
+            return super().acoustic_batch(batch)
+        try:
+            return self._acoustic_padded(batch)
+        except (AttributeError, TypeError, ValueError) as e:
+            print(f"批量推理不可用，退回逐条推理: {e}")
+            self.padded_batch = False
+            return super().acoustic_batch(batch)
+
+    def _acoustic_padded(self, batch):
+        import paddle
+        am = self.executor.am_inference.acoustic_model
+        normalizer = self.executor.am_inference.normalizer
+        ilens = [len(phone_ids) for phone_ids, _ in batch]
+        xs = np.zeros((len(batch), max(ilens)), dtype=np.int64)  # 0 为 <pad>
+        for b, (phone_ids, _) in enumerate(batch):
+            xs[b, :len(phone_ids)] = phone_ids
+        spk_ids = paddle.to_tensor([spk_id for _, spk_id in batch], dtype='int64')
+        with paddle.no_grad():
+            hs, _ = am._forward(paddle.to_tensor(xs), paddle.to_tensor(ilens, dtype='int64'),
+                                is_inference=True, return_after_enc=True, spk_id=spk_ids)
+            # length regulator 输出中 padding 帧全为 0，据此得到每条的帧数并给 decoder 加 mask
+            olens = (hs.abs().sum(-1) > 0).astype('int64').sum(-1)
+            zs, _ = am.decoder(hs, am._source_mask(olens))
+            before_outs = am.feat_out(zs).reshape((len(batch), -1, am.odim))
+            after_outs = before_outs
+            if am.postnet is not None:
+                after_outs = before_outs + am.postnet(before_outs.transpose((0, 2, 1))).transpose((0, 2, 1))
+            olens = olens.numpy()
+            return [normalizer.inverse(after_outs[b, :olens[b]]).numpy() for b in range(len(batch))]
+
+    def _vocode(self, mel):
+        import paddle
+        with paddle.no_grad():
+            wav = self.executor.voc_inference(paddle.to_tensor(mel))
+        return wav.numpy().reshape(-1)
+
+
+class OnnxTTSBackend(TTSBackend):
+    """ONNX Runtime CPU 后端，模型由 `python app.py export-onnx` 导出"""
+    name = 'onnx'
+
+    def __init__(self, model_dir, threads=cpu_threads):
+        super().__init__()
+        Frontend = lazy_import("paddlespeech.t2s.frontend.zh_frontend").Frontend
+        self.frontend = Frontend(phone_vocab_path=phones_dict_path)
+        self.am_sess = onnx_session(os.path.join(model_dir, 'fastspeech2_aishell3.onnx'), threads)
+        self.am_inputs = [i.name for i in self.am_sess.get_inputs()]  # [text, spk_id]
+        self.vocoders['hifigan_aishell3'] = OnnxVocoder(os.path.join(model_dir, 'hifigan_aishell3.onnx'), threads)
+
+    def get_phone_ids(self, text):
+        input_ids = self.frontend.get_input_ids(text, merge_sentences=False)
+        return [ids.numpy() for ids in input_ids["phone_ids"]]
+
+    def acoustic(self, phone_ids, spk_id):
+        feed = {self.am_inputs[0]: phone_ids.astype(np.int64)}
+        if len(self.am_inputs) > 1:
+            feed[self.am_inputs[1]] = np.array([spk_id], dtype=np.int64)
+        return self.am_sess.run(None, feed)[0]
+
+    def _vocode(self, mel):
+        return self.vocoders['hifigan_aishell3'](mel)
+
+
+def load_paddle_model():
+    """加载AISHELL3模型（paddlespeech / paddle 在这里才导入）"""
+    lazy_import("paddle")
+    TTSExecutor = lazy_import("paddlespeech.cli.tts").TTSExecutor
+    model = TTSExecutor()
+    model._init_from_path(
+        am='fastspeech2_aishell3',
+        lang='zh',
+        am_config='/mnt/models/fastspeech2_aishell3/default.yaml',
+        am_ckpt='/mnt/models/fastspeech2_aishell3/snapshot_iter_96400.pdz',
+        am_stat='/mnt/models/fastspeech2_aishell3/speech_stats.npy',
+        phones_dict='/mnt/models/fastspeech2_aishell3/phone_id_map.txt',
+        speaker_dict='/mnt/models/fastspeech2_aishell3/speaker_id_map.txt',
+        voc='hifigan_aishell3',
+        voc_config='/mnt/models/hifigan_aishell3/default.yaml',
+        voc_ckpt='/mnt/models/hifigan_aishell3/snapshot_iter_2500000.pdz',
+        voc_stat='/mnt/models/hifigan_aishell3/feats_stats.npy',
+    )
+    return PaddleTTSBackend(model)
+
+def load_backend(backend):
+    """加载并预热指定后端，加载/预热耗时记入启动报告"""
+    print(f"正在加载AISHELL3模型（{backend}）...")
+    start = time.perf_counter()
+    if backend == 'fake':
+        model = FakeTTSBackend()
+    elif backend == 'onnx':
+        model = OnnxTTSBackend(onnx_dir)
+    else:
+        model = load_paddle_model()
+    loaded = time.perf_counter()
+    model.synthesize("测试加载")  # 预热
+    startup_report["model_load"][backend] = round(loaded - start, 3)
+    startup_report["warmup"][backend] = round(time.perf_counter() - loaded, 3)
+    startup_report["model_ready"][backend] = since_startup()
+    print(f"AISHELL3模型加载成功（{backend}）")
+    return model
+
+
+class FakeTTSBackend(TTSBackend):
+    """压测用假引擎：不加载模型，按 fake_rtf 模拟合成耗时（sleep 不占 CPU），输出正弦波"""
+    name = 'fake'
+    hop_length = 300  # 每帧采样点数，与 HiFiGAN 相同（12.5ms）
+    frames_per_phone = 4
+
+    def __init__(self, rtf=fake_rtf):
+        super().__init__()
+        self.rtf = rtf
+
+    def get_phone_ids(self, text):
+        return [np.arange(2 * len(text), dtype=np.int64)] if text.strip() else []
+
+    def make_frontend(self):
+        return self.get_phone_ids
+
+    def acoustic(self, phone_ids, spk_id):
+        frames = self.frames_per_phone * len(phone_ids)
+        time.sleep(0.3 * self.rtf * frames * self.hop_length / self.fs)  # 声学模型约占 30%
+        return np.full((frames, 80), spk_id, dtype=np.float32)
+
+    def vocode(self, mel, voc=None):
+        """假引擎不区分声码器"""
+        return self._vocode(mel)
+
+    def _vocode(self, mel):
+        samples = len(mel) * self.hop_length
+        time.sleep(0.7 * self.rtf * samples / self.fs)
+        pitch = 220 + 20 * (mel[0, 0] if len(mel) else 0)  # 不同 speaker 音高不同
+        return (0.2 * np.sin(2 * np.pi * pitch * np.arange(samples) / self.fs)).astype(np.float32)
 
-deletion_queue = []  # 等待删除的文件队列
-stop_flag = False  # 中断标志
-current_thread = None  # 当前运行的线程
 
 class TTSManager:
-    """管理 TTS 模型实例（只保留AISHELL3模型）"""
+    """管理 TTS 模型实例（只保留AISHELL3模型，按推理后端分别缓存）"""
     def __init__(self):
         self.models = {}
+        self.lock = threading.Lock()
+
+    def get_model(self, spk_id, backend=None):
+        """返回指定后端的AISHELL3模型实例，并根据spk_id选择speaker"""
+        backend = backend or default_backend
+        with self.lock:
+            if backend not in self.models:
+                self.models[backend] = load_backend(backend)
+        return self.models[backend], spk_id
 
-    def _load_model(self):
-        """延迟加载AISHELL3模型"""
-        print("正在加载AISHELL3模型...")
-        model = TTSExecutor()
-        model(
-            text="测试加载",
-            spk_id=0,  # 默认 speaker id
-            am='fastspeech2_aishell3',
-            lang='zh',
-            am_config='/mnt/models/fastspeech2_aishell3/default.yaml',
-            am_ckpt='/mnt/models/fastspeech2_aishell3/snapshot_iter_96400.pdz',
-            am_stat='/mnt/models/fastspeech2_aishell3/speech_stats.npy',
-            phones_dict='/mnt/models/fastspeech2_aishell3/phone_id_map.txt',
-            speaker_dict='/mnt/models/fastspeech2_aishell3/speaker_id_map.txt',
-            voc='hifigan_aishell3',
-            voc_config='/mnt/models/hifigan_aishell3/default.yaml',
-            voc_ckpt='/mnt/models/hifigan_aishell3/snapshot_iter_2500000.pdz',
-            voc_stat='/mnt/models/hifigan_aishell3/feats_stats.npy',
-        )
-        print("AISHELL3模型加载成功")
-        return model
-
-    def get_model(self, spk_id):
-        """返回AISHELL3模型实例，并根据spk_id选择speaker"""
-        if 'aishell3' not in self.models:
-            self.models['aishell3'] = self._load_model()
-        return self.models['aishell3'], spk_id
 
 # 全局 TTS 管理器
 tts_manager = TTSManager()
 
+def schedule_deletion(path, delay=segment_retention):
+    """delay 秒后由删除线程删除文件或目录"""
+    deletion_queue.append((time.time() + delay, path))
+
 def deletion_worker():
-    """后台定期清理文件"""
+    """后台定期清理到期的文件和任务工作目录"""
     while True:
-        if deletion_queue:
-            temp_file = deletion_queue.pop(0)
+        while deletion_queue and deletion_queue[0][0] <= time.time():
+            _, path = deletion_queue.popleft()
             try:
-                if os.path.exists(temp_file):
-                    os.remove(temp_file)
-                    print(f"已删除文件: {temp_file}")
+                if os.path.isdir(path):
+                    shutil.rmtree(path)
+                    print(f"已删除目录: {path}")
+                elif os.path.exists(path):
+                    os.remove(path)
+                    print(f"已删除文件: {path}")
             except PermissionError:
-                print(f"文件占用中，稍后再试: {temp_file}")
-                deletion_queue.append(temp_file)
+                print(f"文件占用中，稍后再试: {path}")
+                schedule_deletion(path, 1)
         time.sleep(1)
 
 # 启动删除线程
 threading.Thread(target=deletion_worker, daemon=True).start()
 
-def clear_mp3_files(directory):
-    """清理指定目录下的所有.mp3文件"""
-    for file in os.listdir(directory):
-        if file.endswith(".mp3"):
+def publish_event(event, payload):
+    """向所有 /events 订阅者推送一条 SSE 消息；积压过多的订阅者会被断开"""
+    message = f"event: {event}\ndata: {json.dumps(payload, ensure_ascii=False)}\n\n"
+    with event_lock:
+        for subscriber in list(event_subscribers):
+            try:
+                subscriber.put_nowait(message)
+            except queue.Full:
+                event_subscribers.remove(subscriber)
+
+class CostModel:
+    """在线拟合单句合成耗时：elapsed ≈ per_call + per_char × 字数，按 (backend, voc) 分别统计，指数遗忘以适应负载变化"""
+    def __init__(self, decay=0.98, min_samples=5):
+        self.decay = decay
+        self.min_samples = min_samples
+        self.stats = {}  # key -> [权重和, Σx, Σy, Σx², Σxy, 样本数]
+        self.lock = threading.Lock()
+
+    def observe(self, key, chars, elapsed):
+        with self.lock:
+            stat = self.stats.setdefault(key, [0.0, 0.0, 0.0, 0.0, 0.0, 0])
+            for j in range(5):
+                stat[j] *= self.decay
+            stat[0] += 1
+            stat[1] += chars
+            stat[2] += elapsed
+            stat[3] += chars * chars
+            stat[4] += chars * elapsed
+            stat[5] += 1
+
+    def fit(self, key):
+        """返回 (per_call, per_char, 样本数)，样本不足时返回 None"""
+        with self.lock:
+            stat = self.stats.get(key)
+            if not stat or stat[5] < self.min_samples:
+                return None
+            n, sx, sy, sxx, sxy, samples = stat
+        variance = n * sxx - sx * sx
+        if variance <= 1e-9:  # 句长都一样，无法区分固定开销，全部算作单字成本
+            per_call, per_char = 0.0, sy / sx if sx else 0.0
+        else:
+            per_char = (n * sxy - sx * sy) / variance
+            per_call = (sy - per_char * sx) / n
+        return max(per_call, 0.0), max(per_char, 1e-4), samples
+
+cost_model = CostModel()
+
+class RTFEstimator:
+    """按 (backend, voc, spk_id, 句长分桶) 统计实时率（合成耗时 / 音频时长）和每字音频时长，指数遗忘
+
+    样本来自成功完成的任务；某个桶样本不足时依次退回到不分 speaker、不分句长的统计。
+    """
+    buckets = (10, 20, 40)  # 句长分桶上界（字）
+
+    def __init__(self, decay=0.99, min_samples=3):
+        self.decay = decay
+        self.min_samples = min_samples
+        self.stats = {}  # key -> [权重和, Σ合成耗时, Σ音频时长, Σ字数, 样本数]
+        self.lock = threading.Lock()
+
+    def bucket(self, chars):
+        for upper in self.buckets:
+            if chars <= upper:
+                return f"<={upper}"
+        return f">{self.buckets[-1]}"
+
+    def _keys(self, model_key, spk_id, chars):
+        bucket = self.bucket(chars)
+        return [(*model_key, spk_id, bucket), (*model_key, None, bucket), (*model_key, None, None)]
+
+    def observe_job(self, model_key, spk_id, samples):
+        """samples: [(字数, 合成耗时, 音频时长)]"""
+        with self.lock:
+            for chars, elapsed, duration in samples:
+                for key in self._keys(model_key, spk_id, chars):
+                    stat = self.stats.setdefault(key, [0.0, 0.0, 0.0, 0.0, 0])
+                    for j in range(4):
+                        stat[j] *= self.decay
+                    stat[0] += 1
+                    stat[1] += elapsed
+                    stat[2] += duration
+                    stat[3] += chars
+                    stat[4] += 1
+
+    def predict(self, model_key, spk_id, chars):
+        """返回 (合成耗时, 音频时长)，没有足够样本时返回 None"""
+        with self.lock:
+            for key in self._keys(model_key, spk_id, chars):
+                stat = self.stats.get(key)
+                if stat and stat[4] >= self.min_samples and stat[3] > 0:
+                    return chars * stat[1] / stat[3], chars * stat[2] / stat[3]
+        return None
+
+    def snapshot(self):
+        with self.lock:
+            return [{"backend": key[0], "voc": key[1], "spk_id": key[2], "length": key[3],
+                     "rtf": round(stat[1] / stat[2], 4) if stat[2] else None,
+                     "seconds_per_char": round(stat[2] / stat[3], 4) if stat[3] else None, "samples": stat[4]}
+                    for key, stat in self.stats.items() if key[2] is not None]
+
+rtf_estimator = RTFEstimator()
+
+def choose_split_params(key, mode):
+    """根据实测的单次调用开销和单字成本选择拆句长度"""
+    params = {"mode": mode, "first_max_length": split_default_length,
+              "max_length": split_default_length, "cost_model": None}
+    fit = cost_model.fit(key)
+    if fit is None:  # 样本不足，沿用默认长度
+        return params
+    per_call, per_char, samples = fit
+    # 后续句：单次调用开销占比不超过 target_call_overhead，至少保持默认长度
+    max_length = per_call * (1 - target_call_overhead) / (target_call_overhead * per_char)
+    max_length = int(min(max(max_length, split_default_length), split_max_length))
+    first_max_length = max_length
+    if mode == 'latency':  # 首句：合成耗时不超过 target_first_audio
+        first_max_length = (target_first_audio - per_call) / per_char
+        first_max_length = int(min(max(first_max_length, split_min_length), max_length))
+    params.update(first_max_length=first_max_length, max_length=max_length, cost_model={
+        "per_call": round(per_call, 4), "per_char": round(per_char, 5), "samples": samples,
+    })
+    return params
+
+class Histogram:
+    """固定分桶的直方图（线程安全），用于 /stats"""
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        with self.lock:
+            self.counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.count += 1
+            self.total += value
+
+    def snapshot(self):
+        with self.lock:
+            labels = [f"<={b}" for b in self.buckets] + [f">{self.buckets[-1]}"]
+            return {"count": self.count, "mean": round(self.total / self.count, 3) if self.count else None,
+                    "buckets": [[label, count] for label, count in zip(labels, self.counts)]}
+
+
+class FrontendPool:
+    """文本前端（文本正则化、G2P）的预计算线程池
+
+    每个任务合成时把后面若干句提交进来（prefetch_ahead），前端线程各自持有独立的前端实例，不占用模型锁，
+    前端计算与声学模型、声码器的推理重叠。合成到某句时：已算好直接取，正在算就等待，
+    还没开始算（排在其他任务的预取后面）则取消、在模型锁内即时计算，短任务不会排在长任务后面。
+    预取总数达到 limit 时不再接收新的预取。
+    """
+    def __init__(self, workers, limit=frontend_prefetch_limit):
+        self.workers = workers
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix="frontend") if workers > 0 else None
+        self.limit = limit
+        self.pending = collections.OrderedDict()  # (id(模型), 句子) -> Future
+        self.local = threading.local()  # 每个前端线程按后端名称缓存自己的前端实例
+        self.lock = threading.Lock()
+        self.counts = {"prefetched": 0, "refused": 0, "ready": 0, "waited": 0, "cancelled": 0, "inline": 0}
+        self.wait_seconds = 0.0
+
+    def _run(self, model, text):
+        frontend = getattr(self.local, model.name, None)
+        if frontend is None:
+            frontend = model.make_frontend()
+            setattr(self.local, model.name, frontend)
+        return frontend(text)
+
+    def prefetch(self, model, texts):
+        """提交一批句子的前端计算，返回本次提交的键（任务结束时交给 release）"""
+        if self.executor is None:
+            return []
+        keys = []
+        with self.lock:
+            for text in texts:
+                key = (id(model), text)
+                if key in self.pending:
+                    continue
+                if len(self.pending) >= self.limit:  # 不淘汰已有的预取（它们是各任务马上要用的句子）
+                    self.counts["refused"] += 1
+                    continue
+                self.pending[key] = self.executor.submit(self._run, model, text)
+                keys.append(key)
+            self.counts["prefetched"] += len(keys)
+        return keys
+
+    def release(self, keys):
+        """任务结束或中断时丢弃还没用到的预取（还没开始计算的直接取消）"""
+        with self.lock:
+            for key in keys:
+                future = self.pending.pop(key, None)
+                if future is not None:
+                    future.cancel()
+
+    def phone_ids(self, model, text):
+        """取一句的 phone id：预取已算好或正在算时使用预取结果，否则在模型锁内即时计算"""
+        with self.lock:
+            future = self.pending.pop((id(model), text), None)
+            if future is not None and future.cancel():
+                self.counts["cancelled"] += 1  # 还没开始算，不等排在前面的预取
+                future = None
+            if future is None:
+                self.counts["inline"] += 1
+            else:
+                self.counts["ready" if future.done() else "waited"] += 1
+        if future is None:
+            with model.lock:
+                return model.get_phone_ids(text)
+        start = time.perf_counter()
+        phone_ids = future.result()
+        with self.lock:
+            self.wait_seconds += time.perf_counter() - start
+        return phone_ids
+
+    def snapshot(self):
+        with self.lock:
+            return {"workers": self.workers, "pending": len(self.pending),
+                    **self.counts, "wait_seconds": round(self.wait_seconds, 3)}
+
+frontend_pool = FrontendPool(frontend_workers)
+
+def frontend_loader(data):
+    """需要预取前端时返回取本机模型的函数；协调模式（句子在 worker 上合成）或关闭预取时返回 None
+
+    返回函数而不是模型：全部由短语库或缓存给出的任务不会因为预取而加载模型。
+    """
+    if worker_pool or frontend_pool.executor is None:
+        return None
+    return lambda: tts_manager.get_model(int(data.get("spk_id", 0)), data.get("backend", default_backend))[0]
+
+def needs_frontend(data, sentence):
+    """短语库或共享缓存能直接给出音频的句子不需要前端"""
+    spk_id, backend, voc = int(data.get("spk_id", 0)), data.get("backend", default_backend), data.get("voc", default_voc)
+    return not (phrase_bank.contains(sentence, spk_id, backend, voc) or
+                segment_cache.contains(sentence, spk_id, backend, voc))
+
+def prefetch_ahead(load_model, sentences, wanted, depth=frontend_lookahead):
+    """逐句产出 sentences，同时让后面 depth 句中 wanted(序号, 句子) 为真的句子提前计算前端
+
+    load_model 在第一次遇到需要预取的句子时才调用。取下一句时丢弃上一句没用到的预取（如重复句、缓存命中），
+    任务结束或中断时丢弃窗口内剩余的预取。
+    """
+    window = collections.deque()  # (句子, 预取的键)
+    keys = []
+    model = None
+    try:
+        for index, sentence in enumerate(sentences):
+            pending = []
+            if wanted(index, sentence):
+                model = model or load_model()
+                pending = frontend_pool.prefetch(model, [sentence])
+            window.append((sentence, pending))
+            if len(window) > depth:
+                sentence, keys = window.popleft()
+                yield sentence
+                frontend_pool.release(keys)
+        while window:
+            sentence, keys = window.popleft()
+            yield sentence
+            frontend_pool.release(keys)
+    finally:
+        frontend_pool.release(keys + [key for _, pending in window for key in pending])
+
+class BatchScheduler:
+    """跨任务的声学模型动态批处理
+
+    所有任务的待合成句子先进入队列，调度线程从第一条到达起等待 window_ms（或凑满 max_batch），
+    按模型分组做一次批量推理，再把 mel 分发回各自的任务；声码器仍在各任务线程中执行。
+    """
+    def __init__(self, window_ms, max_batch):
+        self.window = window_ms / 1000
+        self.max_batch = max_batch
+        self.pending = []  # (模型, phone_ids, spk_id, Future, 提交时间)
+        self.cond = threading.Condition()
+        self.batch_sizes = Histogram([1, 2, 4, 8, 16, 32])
+        self.latency_ms = Histogram([5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000])
+        threading.Thread(target=self._worker, daemon=True).start()
+
+    def submit(self, model, phone_ids, spk_id):
+        future = Future()
+        with self.cond:
+            self.pending.append((model, phone_ids, spk_id, future, time.time()))
+            self.cond.notify()
+        return future
+
+    def synthesize(self, model, text, spk_id=0, voc=None):
+        """文本前端（优先使用预取结果）-> 批处理的声学模型 -> 声码器，返回 (float32 波形, 服务耗时)
+
+        服务耗时只算本句实际占用模型的时间（批量推理按 phone 数分摊 + 声码器），不含批处理窗口、
+        排队和等待模型锁的时间，供成本估计使用：其他任务的占用由 predict_finish 单独计入。
+        """
+        phone_ids = frontend_pool.phone_ids(model, text)
+        futures = [self.submit(model, ids, spk_id) for ids in phone_ids]
+        wavs, service = [], 0.0
+        for future in futures:
+            mel, acoustic_seconds = future.result()
+            with model.lock:
+                start = time.perf_counter()
+                wavs.append(model.vocode(mel, voc))
+                service += acoustic_seconds + time.perf_counter() - start
+        if not wavs:
+            return np.zeros(0, dtype=np.float32), service
+        return np.concatenate(wavs), service
+
+    def _worker(self):
+        while True:
+            with self.cond:
+                while not self.pending:
+                    self.cond.wait()
+                deadline = self.pending[0][4] + self.window
+                while len(self.pending) < self.max_batch and time.time() < deadline:
+                    self.cond.wait(deadline - time.time())
+                batch, self.pending = self.pending[:self.max_batch], self.pending[self.max_batch:]
+            self.batch_sizes.observe(len(batch))
+            for model in {id(item[0]): item[0] for item in batch}.values():
+                group = [item for item in batch if item[0] is model]
+                try:
+                    with model.lock:
+                        start = time.perf_counter()
+                        mels = profile_batch(model.acoustic_batch, [(item[1], item[2]) for item in group])
+                        elapsed = time.perf_counter() - start
+                except Exception as e:
+                    for item in group:
+                        item[3].set_exception(e)
+                    continue
+                phones = sum(len(item[1]) for item in group) or 1
+                for item, mel in zip(group, mels):
+                    self.latency_ms.observe((time.time() - item[4]) * 1000)
+                    item[3].set_result((mel, elapsed * len(item[1]) / phones))
+
+    def snapshot(self):
+        return {"window_ms": self.window * 1000, "max_batch": self.max_batch,
+                "batch_size": self.batch_sizes.snapshot(), "latency_ms": self.latency_ms.snapshot()}
+
+batch_scheduler = BatchScheduler(batch_window_ms, batch_max_size)
+
+def synthesize_local(sentence, spk_id, backend, voc):
+    """本机合成一句（先查共享缓存，未命中时批处理推理并写入缓存），返回 (int16 PCM 数组, 采样率, 服务耗时)
+
+    命中缓存时直接返回缓存文件的只读 mmap，不做转换；服务耗时见 BatchScheduler.synthesize，命中缓存时为 None。
+    """
+    cached = segment_cache.lookup(sentence, spk_id, backend, voc)
+    if cached is not None:
+        pcm, fs = cached
+        return pcm, fs, None
+    model, speaker_id = tts_manager.get_model(spk_id, backend)
+    wav, service = batch_scheduler.synthesize(model, sentence, speaker_id, voc)
+    pcm = to_int16(wav)
+    segment_cache.store(sentence, spk_id, backend, voc, pcm, model.fs)
+    return pcm, model.fs, service
+
+def synthesize_sentence(sentence, spk_id, backend, voc):
+    """合成一句，返回 (int16 PCM 数组, 采样率, 服务耗时)：协调模式下转发给 worker，否则在本机推理"""
+    if worker_pool:
+        return worker_pool.synthesize(sentence, spk_id, backend, voc)
+    return synthesize_local(sentence, spk_id, backend, voc)
+
+class WorkerPool:
+    """协调模式：把句子转发给多个 worker 节点合成
+
+    按 (voc, spk_id, 归一化文本) 做 rendezvous hash，同一句总是落在同一个 worker 上（缓存亲和），
+    增减 worker 只影响少量句子。后台定期 GET /health，请求失败时标记为不可用并按哈希顺序换下一个。
+    """
+    fs = TTSBackend.fs
+
+    def __init__(self, urls, interval=5.0, timeout=60.0):
+        self.timeout = timeout
+        self.interval = interval
+        self.workers = {url.rstrip('/'): {"healthy": True, "requests": 0, "errors": 0, "last_error": None}
+                        for url in urls}
+        self.lock = threading.Lock()
+        threading.Thread(target=self._health_worker, daemon=True).start()
+
+    def _mark(self, url, healthy, error=None):
+        with self.lock:
+            state = self.workers[url]
+            if state["healthy"] != healthy:
+                print(f"worker {url} {'恢复' if healthy else '不可用'}{f': {error}' if error else ''}")
+            state["healthy"] = healthy
+            if error:
+                state["errors"] += 1
+                state["last_error"] = str(error)
+
+    def _health_worker(self):
+        while True:
+            for url in list(self.workers):
+                try:
+                    with urllib.request.urlopen(f"{url}/health", timeout=2) as response:
+                        self._mark(url, response.status == 200)
+                except (urllib.error.URLError, OSError) as e:
+                    self._mark(url, False, e)
+            time.sleep(self.interval)
+
+    def ranked(self, key):
+        """rendezvous hash：按 hash(worker, key) 从大到小排序，健康的在前"""
+        order = sorted(self.workers, key=lambda url: hashlib.md5(f"{url}|{key}".encode()).digest(), reverse=True)
+        return [url for url in order if self.workers[url]["healthy"]] + \
+            [url for url in order if not self.workers[url]["healthy"]]
+
+    def synthesize(self, sentence, spk_id, backend, voc):
+        body = json.dumps({"text": sentence, "spk_id": spk_id, "backend": backend, "voc": voc}).encode()
+        last_error = None
+        for url in self.ranked(f"{voc}|{spk_id}|{normalize_sentence(sentence)}"):
+            req = urllib.request.Request(f"{url}/worker/synthesize", data=body,
+                                         headers={"Content-Type": "application/json"})
+            try:
+                with urllib.request.urlopen(req, timeout=self.timeout) as response:
+                    pcm, fs = response.read(), int(response.headers["X-Sample-Rate"])
+                    service = response.headers.get("X-Service-Time")
+                    service = float(service) if service else None
+            except urllib.error.HTTPError as e:
+                # worker 正常响应了错误（如模型处理不了这一句），不是节点故障：不标记不可用、不换 worker
+                with self.lock:
+                    self.workers[url]["errors"] += 1
+                    self.workers[url]["last_error"] = str(e)
+                detail = e.read().decode("utf-8", errors="replace")[:500]
+                raise RuntimeError(f"worker {url} 合成失败（HTTP {e.code}）: {detail}") from e
+            except (urllib.error.URLError, OSError, ValueError, TypeError) as e:
+                self._mark(url, False, e)  # 连接失败或超时：换下一个 worker
+                last_error = e
+                continue
+            with self.lock:
+                self.workers[url]["requests"] += 1
+            if fs != self.fs:
+                raise RuntimeError(f"worker {url} 采样率 {fs} 与协调节点 {self.fs} 不一致")
+            return np.frombuffer(pcm, dtype='<i2'), fs, service
+        raise RuntimeError(f"没有可用的 worker: {last_error}")
+
+    def snapshot(self):
+        with self.lock:
+            return {url: dict(state) for url, state in self.workers.items()}
+
+class ProfileSession:
+    """一次在线性能分析，覆盖接下来 N 个任务或 T 秒内开始的任务
+
+    被覆盖任务的线程（generate_audio_task 及其中的前端、声码器、merge_audio_files）和
+    这期间批处理线程中的声学模型推理都会被分析：cProfile 结果导出为 pstats，
+    栈采样结果导出为 collapsed stacks（flamegraph.pl / speedscope 可直接打开）。
+    """
+    modes = ('both', 'cprofile', 'sample')
+
+    def __init__(self, jobs=None, seconds=None, mode='both', interval=0.01):
+        self.session_id = uuid.uuid4().hex[:12]
+        self.mode = mode
+        self.interval = interval
+        self.remaining_jobs = jobs
+        self.deadline = time.time() + seconds if seconds else None
+        self.status = "running"
+        self.started_at, self.finished_at = time.time(), None
+        self.profiled_jobs = 0
+        self.active_jobs = 0
+        self.threads = set()  # 正在分析的线程 ident
+        self.stats = None  # 合并后的 pstats.Stats
+        self.stacks = collections.Counter()  # 折叠后的调用栈 -> 采样次数
+        self.lock = threading.Lock()
+        if mode != 'cprofile':
+            threading.Thread(target=self._sampler, daemon=True).start()
+        if seconds:
+            timer = threading.Timer(seconds, self._maybe_finish)
+            timer.daemon = True  # 不阻止服务退出
+            timer.start()
+
+    def _accepting(self):
+        if self.deadline and time.time() >= self.deadline:
+            return False
+        return self.remaining_jobs is None or self.remaining_jobs > 0
+
+    def begin_job(self):
+        """新任务开始时调用，返回这个任务是否在分析范围内"""
+        with self.lock:
+            if self.status != "running" or not self._accepting():
+                return False
+            if self.remaining_jobs is not None:
+                self.remaining_jobs -= 1
+            self.profiled_jobs += 1
+            self.active_jobs += 1
+            return True
+
+    def end_job(self):
+        with self.lock:
+            self.active_jobs -= 1
+        self._maybe_finish()
+
+    def profile(self, func, *args):
+        """在当前线程中分析 func(*args)"""
+        ident = threading.get_ident()
+        with self.lock:
+            self.threads.add(ident)
+        profiler = cProfile.Profile() if self.mode != 'sample' else None
+        try:
+            if profiler:
+                profiler.enable()
+        except ValueError:  # 新版本 Python 同一时间只允许一个 cProfile，这个线程只做栈采样
+            profiler = None
+        try:
+            return func(*args)
+        finally:
+            if profiler:
+                profiler.disable()
+            with self.lock:
+                self.threads.discard(ident)
+                if profiler:
+                    if self.stats is None:
+                        self.stats = pstats.Stats(profiler)
+                    else:
+                        self.stats.add(profiler)
+
+    def _sampler(self):
+        while self.status == "running":
+            frames = sys._current_frames()
+            with self.lock:
+                threads = list(self.threads)
+            samples = []
+            for ident in threads:
+                stack, frame = [], frames.get(ident)
+                while frame is not None:
+                    stack.append(f"{os.path.basename(frame.f_code.co_filename)}:{frame.f_code.co_name}")
+                    frame = frame.f_back
+                if stack:
+                    samples.append(";".join(reversed(stack)))
+            with self.lock:
+                self.stacks.update(samples)
+            time.sleep(self.interval)
+
+    def _maybe_finish(self):
+        """覆盖的任务都已结束且不再接收新任务时导出结果"""
+        with self.lock:
+            if self.status != "running" or self.active_jobs or self._accepting():
+                return
+            self.status = "writing"
+        os.makedirs(profiles_dir, exist_ok=True)
+        if self.stats is not None:
+            write_atomic(self.path("pstats"), self.stats.dump_stats)
+        if self.mode != 'cprofile':
+            with self.lock:
+                stacks = self.stacks.most_common()
+
+            def write(temp_path):
+                with open(temp_path, "w", encoding="utf-8") as f:
+                    for stack, count in stacks:
+                        f.write(f"{stack} {count}\n")
+            write_atomic(self.path("collapsed"), write)
+        self.status, self.finished_at = "finished", time.time()
+        print(f"性能分析完成: {self.session_id}，覆盖 {self.profiled_jobs} 个任务")
+
+    def path(self, kind):
+        return os.path.join(profiles_dir, f"{self.session_id}.{kind}")
+
+    def snapshot(self):
+        files = [kind for kind in ("pstats", "collapsed") if self.status == "finished" and os.path.exists(self.path(kind))]
+        with self.lock:
+            samples = sum(self.stacks.values())
+        return {"session_id": self.session_id, "status": self.status, "mode": self.mode,
+                "profiled_jobs": self.profiled_jobs, "remaining_jobs": self.remaining_jobs,
+                "deadline": self.deadline, "started_at": self.started_at, "finished_at": self.finished_at,
+                "samples": samples,
+                "downloads": [f"/admin/profile/{self.session_id}/{kind}" for kind in files]}
+
+profile_sessions = []  # 最近的分析会话，最后一个可能正在运行
+
+def current_profile():
+    session = profile_sessions[-1] if profile_sessions else None
+    return session if session and session.status == "running" else None
+
+def run_profiled(func, *args):
+    """任务线程入口：在分析范围内时带着分析执行 func"""
+    session = current_profile()
+    if session is None or not session.begin_job():
+        return func(*args)
+    try:
+        return session.profile(func, *args)
+    finally:
+        session.end_job()
+
+def profile_batch(func, *args):
+    """批处理线程：有被分析的任务在运行时分析这一批推理"""
+    session = current_profile()
+    if session is None or not session.active_jobs:
+        return func(*args)
+    return session.profile(func, *args)
+
+def write_atomic(path, write):
+    """先写同目录下的隐藏临时文件，再原子重命名到 path，播放端和下载方不会读到写了一半的文件"""
+    directory, name = os.path.split(path)
+    temp_path = os.path.join(directory, f".{name}")
+    write(temp_path)
+    os.replace(temp_path, path)
+
+class PhraseBank:
+    """预渲染短语库：所有短语的 16bit PCM 依次存放在 <path>.pcm，<path>.json 为索引
+
+    由 python app.py build-phrases 离线生成；启动时只读索引并 mmap 音频文件，
+    按 (voc, spk_id, 归一化文本) 查找，命中时直接返回音频，不做推理。只对生成短语库时使用的后端生效，
+    其他后端的请求一律视为未收录（音色、采样率可能不同）。
+    """
+    def __init__(self, path):
+        self.index = {}  # (voc, spk_id, 文本) -> (采样点偏移, 采样点数)
+        self.pcm = None
+        self.fs = TTSBackend.fs
+        self.backend = None
+        self.hits = 0
+        if not (os.path.exists(f"{path}.json") and os.path.exists(f"{path}.pcm")):
+            return
+        with open(f"{path}.json", encoding="utf-8") as f:
+            meta = json.load(f)
+        self.fs = meta["fs"]
+        self.backend = meta["backend"]
+        self.index = {(voc, spk_id, text): (offset, length) for voc, spk_id, text, offset, length in meta["entries"]}
+        if os.path.getsize(f"{path}.pcm"):
+            self.pcm = np.memmap(f"{path}.pcm", dtype='<i2', mode='r')
+
+    @staticmethod
+    def key(text):
+        """句末标点只影响停顿，查找时忽略"""
+        return normalize_sentence(text).rstrip('。！？.!?，,；;')
+
+    def contains(self, text, spk_id, backend, voc):
+        return self.pcm is not None and backend == self.backend and (voc, spk_id, self.key(text)) in self.index
+
+    def lookup_pcm(self, text, spk_id, backend, voc):
+        """返回 int16 PCM（mmap 的切片，不复制），未收录时返回 None"""
+        entry = self.index.get((voc, spk_id, self.key(text)))
+        if entry is None or self.pcm is None or backend != self.backend:
+            return None
+        self.hits += 1
+        offset, length = entry
+        return self.pcm[offset:offset + length]
+
+    def lookup(self, text, spk_id, backend, voc):
+        """返回 float32 波形，未收录时返回 None"""
+        pcm = self.lookup_pcm(text, spk_id, backend, voc)
+        return None if pcm is None else pcm.astype(np.float32) / 32768
+
+    def snapshot(self):
+        return {"entries": len(self.index), "hits": self.hits, "fs": self.fs, "backend": self.backend}
+
+class SegmentCache:
+    """多进程共享的句子音频缓存：<dir>/index.db 为 SQLite（WAL）索引，音频为 <dir>/blobs/ 下的 16bit PCM 文件
+
+    键为 (模型版本, 后端, 声码器, spk_id, 归一化文本) 的哈希，同一台机器上的服务进程和 worker 共用一个目录，
+    任何一个进程合成过的句子其余进程都能直接使用。读取时 mmap 音频文件，不经过额外的读缓冲；
+    总大小超过上限时按最近使用时间淘汰。命中率在所有进程间累计（见 GET /stats 的 segment_cache）。
+    """
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.local = threading.local()  # sqlite3 连接不能跨线程使用，每个线程一个
+        self.lock = threading.Lock()
+        self.hits = self.misses = 0  # 本进程的统计
+        if self.enabled:
+            os.makedirs(os.path.join(path, "blobs"), exist_ok=True)
+            with self.db() as db:
+                db.execute("CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, size INTEGER, fs INTEGER, "
+                           "last_used REAL, hits INTEGER DEFAULT 0)")
+                db.execute("CREATE INDEX IF NOT EXISTS entries_last_used ON entries (last_used)")
+                db.execute("CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER)")
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def db(self):
+        if getattr(self.local, "db", None) is None:
+            db = sqlite3.connect(os.path.join(self.path, "index.db"), timeout=30, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self.local.db = db
+        return self.local.db
+
+    @staticmethod
+    def key(text, spk_id, backend, voc):
+        return hashlib.sha1(f"{model_version}|{backend}|{voc}|{spk_id}|{normalize_sentence(text)}".encode()).hexdigest()
+
+    def blob_path(self, key):
+        return os.path.join(self.path, "blobs", key[:2], f"{key}.pcm")
+
+    def _count(self, db, name):
+        db.execute("INSERT INTO counters VALUES (?, 1) ON CONFLICT(name) DO UPDATE SET value = value + 1", (name,))
+
+    def contains(self, text, spk_id, backend, voc):
+        """只判断是否已缓存，不计入命中统计"""
+        if not self.enabled:
+            return False
+        row = self.db().execute("SELECT 1 FROM entries WHERE key = ?", (self.key(text, spk_id, backend, voc),)).fetchone()
+        return row is not None
+
+    def lookup(self, text, spk_id, backend, voc):
+        """命中时返回 (只读 mmap 的 int16 数组, 采样率)，否则返回 None"""
+        if not self.enabled:
+            return None
+        key = self.key(text, spk_id, backend, voc)
+        db = self.db()
+        row = db.execute("SELECT size, fs FROM entries WHERE key = ?", (key,)).fetchone()
+        pcm = None
+        if row and row[0]:
             try:
-                os.remove(os.path.join(directory, file))
-                print(f"已删除文件: {file}")
-            except Exception as e:
-                print(f"删除文件失败: {file}, 原因: {e}")
+                # 其他进程可能刚好淘汰了这个文件；已经 mmap 的文件被删除后仍可读
+                pcm = np.memmap(self.blob_path(key), dtype='<i2', mode='r')
+            except FileNotFoundError:
+                pass
+        if pcm is not None:
+            db.execute("UPDATE entries SET last_used = ?, hits = hits + 1 WHERE key = ?", (time.time(), key))
+        self._count(db, "misses" if pcm is None else "hits")
+        with self.lock:
+            if pcm is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return None if pcm is None else (pcm, row[1])
+
+    def store(self, text, spk_id, backend, voc, pcm, fs):
+        """写入一句的 int16 PCM 数组；文件先写到唯一的临时名再原子重命名，多个进程同时写同一句也不会损坏"""
+        if not self.enabled or not len(pcm):
+            return
+        key = self.key(text, spk_id, backend, voc)
+        path = self.blob_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(temp_path, 'wb') as f:
+            pcm.tofile(f)
+        os.replace(temp_path, path)
+        db = self.db()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            db.execute("INSERT OR REPLACE INTO entries (key, size, fs, last_used) VALUES (?, ?, ?, ?)",
+                       (key, pcm.nbytes, fs, time.time()))
+            evicted = self._evict(db)
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        for old_key in evicted:  # 提交后再删文件，索引里不会出现指向已删除文件的记录
+            try:
+                os.remove(self.blob_path(old_key))
+            except FileNotFoundError:
+                pass
+
+    def _evict(self, db):
+        """总大小超过上限时按 last_used 从旧到新淘汰到上限的 90%，返回被淘汰的键"""
+        total = db.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        if total <= self.max_bytes:
+            return []
+        evicted = []
+        for key, size in db.execute("SELECT key, size FROM entries ORDER BY last_used").fetchall():
+            if total <= self.max_bytes * 0.9:
+                break
+            evicted.append(key)
+            total -= size
+        db.executemany("DELETE FROM entries WHERE key = ?", [(key,) for key in evicted])
+        db.execute("INSERT INTO counters VALUES ('evictions', ?) ON CONFLICT(name) DO UPDATE SET value = value + ?",
+                   (len(evicted), len(evicted)))
+        return evicted
+
+    def snapshot(self):
+        if not self.enabled:
+            return {"enabled": False}
+        db = self.db()
+        entries, size = db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries").fetchone()
+        counters = dict(db.execute("SELECT name, value FROM counters").fetchall())
+        hits, misses = counters.get("hits", 0), counters.get("misses", 0)
+        return {"enabled": True, "entries": entries, "mb": round(size / 2 ** 20, 2),
+                "max_mb": round(self.max_bytes / 2 ** 20, 2), "model_version": model_version,
+                "hits": hits, "misses": misses, "hit_rate": round(hits / (hits + misses), 3) if hits + misses else None,
+                "evictions": counters.get("evictions", 0),
+                "process": {"hits": self.hits, "misses": self.misses}}
+
+def trim_silence(wav, fs, threshold_db=-40, margin=0.02):
+    """去掉首尾静音（10ms 帧能量低于峰值 threshold_db），两端保留 margin 秒"""
+    frame = int(fs * 0.01)
+    frames = len(wav) // frame
+    if not frames:
+        return wav
+    energy = np.sqrt(np.mean(wav[:frames * frame].reshape(frames, frame) ** 2, axis=1))
+    loud = np.nonzero(energy > np.max(np.abs(wav)) * 10 ** (threshold_db / 20))[0]
+    if not len(loud):
+        return wav
+    start = max(0, loud[0] * frame - int(margin * fs))
+    end = min(len(wav), (loud[-1] + 1) * frame + int(margin * fs))
+    return wav[start:end]
+
+def splice(pieces, fs, crossfade=join_crossfade):
+    """拼接 [(文本, 波形)]：边界处有标点时插入对应的停顿，否则交叉淡化，避免咔哒声和不自然的空隙"""
+    out, prev_text = None, ''
+    for text, wav in pieces:
+        if out is None or not len(wav):
+            out = wav.copy() if out is None else out
+            prev_text += text  # 纯标点的片段只影响下一个边界的停顿
+            continue
+        boundary = prev_text.rstrip()[-1:] + text.lstrip()[:1]
+        pause = max([pause_seconds.get(ch, 0.0) for ch in boundary] + [0.0])
+        n = min(int(crossfade * fs), len(out), len(wav))
+        if pause or not n:
+            out = np.concatenate([out, np.zeros(int(pause * fs), dtype=np.float32), wav])
+        else:
+            ramp = np.linspace(0, 1, n, dtype=np.float32)
+            out = np.concatenate([out[:-n], out[-n:] * (1 - ramp) + wav[:n] * ramp, wav[n:]])
+        prev_text = text
+    return out if out is not None else np.zeros(0, dtype=np.float32)
+
+def rms(wav):
+    return float(np.sqrt(np.mean(wav ** 2))) if len(wav) else 0.0
+
+class TemplateStore:
+    """播报模板，如 "请{号码}号到{窗口}窗口办理"
+
+    注册时渲染固定部分并缓存，播报时只合成槽位（先查短语库和槽位缓存），
+    槽位音量对齐固定部分后按边界标点拼接。模板定义保存在 templates.json，重启后首次使用时重新渲染。
+    """
+    slot_pattern = re.compile(r'\{(\w+)\}')
+
+    def __init__(self, path):
+        self.path = path
+        self.templates = {}  # 名称 -> 模板定义
+        self.fixed = {}  # 名称 -> 固定部分的 [(文本, 波形, 采样率)]
+        self.slot_cache = collections.OrderedDict()  # (值, spk_id, voc, backend) -> (波形, 采样率)
+        self.lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                self.templates = json.load(f)
+
+    def _save(self):
+        def write(temp_path):
+            with open(temp_path, "w", encoding="utf-8") as f:
+                json.dump(self.templates, f, ensure_ascii=False, indent=2)
+        write_atomic(self.path, write)
+
+    def _piece(self, text, definition):
+        """合成一段文本（先查短语库），返回 (去掉首尾静音的波形, 采样率)"""
+        if not re.search(r'\w', text):
+            return np.zeros(0, dtype=np.float32), phrase_bank.fs
+        fs = phrase_bank.fs
+        pcm = phrase_bank.lookup_pcm(text, definition["spk_id"], definition["backend"], definition["voc"])
+        if pcm is None:
+            pcm, fs, _ = synthesize_sentence(text, definition["spk_id"], definition["backend"], definition["voc"])
+        return trim_silence(pcm.astype(np.float32) / 32768, fs), fs
+
+    def register(self, name, template, spk_id=0, voc=default_voc, backend=default_backend):
+        parts = self.slot_pattern.split(template)  # 固定部分与槽位名交替
+        definition = {"template": template, "slots": parts[1::2], "spk_id": spk_id, "voc": voc, "backend": backend}
+        fixed = [(text, *self._piece(text, definition)) for text in parts[0::2]]
+        with self.lock:
+            self.templates[name] = definition
+            self.fixed[name] = fixed
+            self._save()
+        return definition
+
+    def remove(self, name):
+        with self.lock:
+            self.fixed.pop(name, None)
+            if self.templates.pop(name, None) is None:
+                return False
+            self._save()
+        return True
+
+    def _slot(self, value, definition):
+        key = (value, definition["spk_id"], definition["voc"], definition["backend"])
+        with self.lock:
+            if key in self.slot_cache:
+                self.slot_cache.move_to_end(key)
+                return self.slot_cache[key], False
+        wav = self._piece(value, definition)
+        with self.lock:
+            self.slot_cache[key] = wav
+            if len(self.slot_cache) > template_slot_cache_size:
+                self.slot_cache.popitem(last=False)
+        return wav, True
+
+    def render(self, name, values):
+        """返回 (波形, 采样率, 新合成的槽位数)；values 缺少槽位时抛出 KeyError"""
+        definition = self.templates[name]
+        fixed = self.fixed.get(name)
+        if fixed is None:  # 重启后第一次使用
+            fixed = self.fixed[name] = [(text, *self._piece(text, definition))
+                                        for text in self.slot_pattern.split(definition["template"])[0::2]]
+        level = np.mean([rms(wav) for _, wav, _ in fixed if len(wav)] or [0.0])
+        pieces, synthesized = [fixed[0]], 0
+        for slot, part in zip(definition["slots"], fixed[1:]):
+            value = str(values[slot])
+            (wav, fs), new = self._slot(value, definition)
+            synthesized += new
+            if level and rms(wav):  # 单独合成的槽位音量与固定部分对齐
+                wav = wav * float(np.clip(level / rms(wav), 0.5, 2.0))
+            pieces += [(value, wav, fs), part]
+        rates = {fs for _, wav, fs in pieces if len(wav)}
+        if len(rates) > 1:  # 短语库与模型的采样率不一致，拼接前无法对齐
+            raise RuntimeError(f"模板片段采样率不一致: {sorted(rates)}")
+        fs = rates.pop() if rates else phrase_bank.fs
+        return splice([(text, wav) for text, wav, _ in pieces], fs), fs, synthesized
+
+class Mp3Encoder:
+    """把 16bit PCM 通过标准输入交给 ffmpeg 编码成 mp3，内存中不保留整段音频"""
+    def __init__(self, path, fs, channels=1):
+        self.process = subprocess.Popen(
+            ['ffmpeg', '-loglevel', 'error', '-y', '-f', 's16le', '-ar', str(fs), '-ac', str(channels),
+             '-i', 'pipe:0', '-f', 'mp3', path], stdin=subprocess.PIPE)
+
+    def write(self, pcm):
+        self.process.stdin.write(pcm)
+
+    def close(self):
+        self.process.stdin.close()
+        if self.process.wait() != 0:
+            raise RuntimeError(f"ffmpeg 编码失败，返回码 {self.process.returncode}")
+
+    def abort(self):
+        self.process.kill()
+        self.process.wait()
+
+class JobCancelled(Exception):
+    """任务被 /stop_audio 中断"""
+
+class JobStore:
+    """任务持久化：计划（请求参数、拆句结果）只写一次，每完成一个片段追加一行进度"""
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, job_id, ext):
+        return os.path.join(self.directory, f"{job_id}.{ext}")
+
+    def save_plan(self, job, data, sentences):
+        plan = {"job_id": job["job_id"], "name": job["name"], "data": data, "sentences": sentences,
+                "split_params": job["split_params"], "created_at": job["created_at"]}
 
-def generate_audio_task(data):
-    global stop_flag
+        def write(temp_path):
+            with open(temp_path, "w", encoding="utf-8") as f:
+                json.dump(plan, f, ensure_ascii=False)
+        write_atomic(self._path(job["job_id"], "json"), write)
 
-    base_name = data.get("name", "audio_segment")
-    raw_text = data.get("text", "你好，欢迎使用PaddleSpeech。")
+    def record_segment(self, job_id, index, source, duration):
+        """记录片段 index 已生成（source 为去重后实际使用的片段序号）"""
+        with open(self._path(job_id, "log"), "a", encoding="utf-8") as f:
+            f.write(json.dumps({"index": index, "source": source, "duration": duration}) + "\n")
+
+    def remove(self, job_id):
+        for ext in ("json", "log"):
+            try:
+                os.remove(self._path(job_id, ext))
+            except FileNotFoundError:
+                pass
+
+    def unfinished(self):
+        """返回 [(计划, {片段序号: (source, 时长)})]，按创建时间排序"""
+        result = []
+        for file in os.listdir(self.directory):
+            if not file.endswith(".json") or file.startswith("."):
+                continue
+            with open(os.path.join(self.directory, file), encoding="utf-8") as f:
+                plan = json.load(f)
+            progress = {}
+            if os.path.exists(self._path(plan["job_id"], "log")):
+                with open(self._path(plan["job_id"], "log"), encoding="utf-8") as f:
+                    for line in f:
+                        try:
+                            record = json.loads(line)
+                        except ValueError:  # 重启前最后一行可能没写完
+                            continue
+                        progress[record["index"]] = (record["source"], record["duration"])
+            result.append((plan, progress))
+        return sorted(result, key=lambda item: item[0]["created_at"])
+
+job_store = JobStore(job_state_dir)
+
+bank_start = time.perf_counter()
+phrase_bank = PhraseBank(phrase_bank_path)
+startup_report["phrase_bank"] = {"entries": len(phrase_bank.index), "load": round(time.perf_counter() - bank_start, 3)}
+template_store = TemplateStore(templates_path)
+segment_cache = SegmentCache(segment_cache_dir, int(segment_cache_mb * 2 ** 20))
+
+def create_job(data, job_id=None):
+    """登记一个新任务，返回任务状态"""
+    job = {
+        "job_id": job_id or uuid.uuid4().hex[:12],
+        "name": data.get("name", "audio_segment"),
+        "status": "queued",
+        "segments": None,  # 拆句后的片段总数
+        "completed": 0,
+        "duration": 0.0,  # 已生成音频时长（秒）
+        "url": None,
+        "error": None,
+        "stats": None,  # 去重等合成统计
+        "split_params": None,  # 自动选择的拆句参数
+        "resumed_from": None,  # 重启后续做时第一个缺失的片段序号
+        "estimated_cost": 0.0,  # 提交时估计的合成耗时（秒），用于准入控制
+        "estimated_duration": None,  # 预计音频时长（秒）
+        "estimated_finish_at": None,  # 预计完成时间（时间戳），查询状态时按当前负载更新
+        "cancel_requested": False,  # /stop_audio 中断标志
+        "created_at": time.time(),
+        "finished_at": None,
+    }
+    jobs[job["job_id"]] = job
+    # 只清理已结束的任务：排队中、运行中的任务还要用于准入控制、同名检查和 /stop_audio
+    finished = [job_id for job_id, item in list(jobs.items()) if item["status"] in ("finished", "cancelled", "failed")]
+    for job_id in finished[:max(0, len(jobs) - max_job_history)]:
+        jobs.pop(job_id, None)
+    return job
+
+def finish_job(job, status, event, **payload):
+    """更新任务终态并推送对应事件，任务结束后不再需要续做，工作目录稍后删除"""
+    job.update(status=status, finished_at=time.time(), **payload)
+    job_store.remove(job["job_id"])
+    schedule_deletion(job_dir(job["job_id"]))
+    publish_event(event, {"job_id": job["job_id"], "name": job["name"], "completed": job["completed"], **payload})
+
+def job_dir(job_id):
+    """任务的工作目录（片段、长文档原文）"""
+    return os.path.join(segments_dir, job_id)
+
+def segment_path(job, index):
+    """第 index 个片段的文件路径（播放端按 _0000 序号排序）"""
+    return os.path.join(job_dir(job["job_id"]), f"{job['name']}_{index:04d}.mp3")
+
+def plan_sentences(data):
+    """选择拆句参数并拆句，返回 (拆句参数, 句子列表)"""
+    backend = data.get("backend", default_backend)
+    voc = data.get("voc", default_voc)
+    split_params = choose_split_params((backend, voc), data.get("latency_mode", default_split_mode))
+    sentences = split_text_into_sentences(
+        data.get("text", "你好，欢迎使用PaddleSpeech。"),
+        split_params["max_length"], split_params["first_max_length"])
+    return split_params, sentences
+
+def plan_job(data, job):
+    """拆句并持久化计划，之后才开始合成"""
+    job["split_params"], sentences = plan_sentences(data)
+    job_store.save_plan(job, data, sentences)
+    return sentences
+
+def generate_audio_task(data, job, sentences=None, progress=None):
+    try:
+        if sentences is None:
+            sentences = plan_job(data, job)
+        run_audio_job(data, job, sentences, progress or {})
+    except Exception as e:
+        print(f"音频生成失败: {e}")
+        finish_job(job, "failed", "job-failed", error=str(e))
+
+def run_audio_job(data, job, sentences, progress):
+    """逐句合成；progress 为重启前已完成的片段，对应文件仍在时跳过"""
+    base_name = job["name"]
     spk_id = int(data.get("spk_id", 0))  # 默认使用spk_id=0
+    backend = data.get("backend", default_backend)
+    voc = data.get("voc", default_voc)
 
-    sentences = split_text_into_sentences(raw_text)
+    stats = {"sentences": len(sentences), "synthesized": 0, "reused": 0, "bank_hits": 0, "cache_hits": 0,
+             "saved_chars": 0, "saved_seconds": 0.0}
+    job.update(status="running", segments=len(sentences), stats=stats)
+    os.makedirs(job_dir(job["job_id"]), exist_ok=True)
+    publish_event("job-started", {"job_id": job["job_id"], "name": base_name, "segments": len(sentences)})
 
-    audio_files = []
+    merge_sources = []  # 每个位置实际使用的音频（重复句指向首次生成的片段）
+    samples = []  # (字数, 合成耗时, 音频时长)，任务成功完成后计入 RTF 统计
+    rendered = {}  # 归一化句子 -> (首次生成的片段序号, 音频时长, 合成耗时)
+    # 短语库的采样率须与合成的片段一致（合并时不重采样）；本机模型还没加载时不为此加载，短语库已限定为同一后端
+    model = None if worker_pool else tts_manager.models.get(backend)
+    use_bank = phrase_bank.fs == (worker_pool.fs if worker_pool else model.fs if model is not None else phrase_bank.fs)
+    load_model = frontend_loader(data)
+    if load_model is not None:
+        # 已完成的片段、短语库和共享缓存命中的句子不预取前端
+        sentences = prefetch_ahead(load_model, sentences, lambda index, sentence:
+                                   index not in progress and needs_frontend(data, sentence))
     for i, sentence in enumerate(sentences):
-        if stop_flag:  # 检查中断标志
+        if job["cancel_requested"]:  # 检查中断标志
             print("中断音频生成任务")
-            return jsonify({"message": "音频生成已被中断"}), 200
+            finish_job(job, "cancelled", "job-cancelled")
+            return
 
-        audio_path = os.path.join(output_dir, f"{base_name}_{i:04d}.mp3")
-        model, speaker_id = tts_manager.get_model(spk_id)
-        model(
-            text=sentence, output=audio_path, spk_id=speaker_id,
-            am='fastspeech2_aishell3', lang='zh'
-        )
-        audio_files.append(audio_path)
+        audio_path = segment_path(job, i)
+        key = normalize_sentence(sentence)
+        if i in progress and os.path.exists(audio_path):
+            # 重启前已完成的片段
+            source, duration = progress[i]
+            rendered.setdefault(key, (source, duration, 0.0))
+            stats["synthesized" if source == i else "reused"] += 1
+            merge_sources.append(segment_path(job, source))
+            job["completed"] += 1
+            job["duration"] += duration
+            continue
+        if progress and job["resumed_from"] is None:
+            job["resumed_from"] = i
+            print(f"任务 {base_name} 从第 {i} 个片段继续生成")
+
+        bank_wav = None if key in rendered or not use_bank else phrase_bank.lookup(sentence, spk_id, backend, voc)
+        if key in rendered:
+            # 同一任务内重复的句子直接复用首次生成的音频
+            source, duration, cost = rendered[key]
+            source_path = segment_path(job, source)
+            write_atomic(audio_path, lambda temp_path: shutil.copyfile(source_path, temp_path))
+            stats["reused"] += 1
+            stats["saved_chars"] += len(sentence)
+            stats["saved_seconds"] = round(stats["saved_seconds"] + cost, 3)
+        elif bank_wav is not None:
+            # 短语库命中，不做推理
+            write_atomic(audio_path, lambda temp_path: sf.write(temp_path, bank_wav, samplerate=phrase_bank.fs))
+            duration = len(bank_wav) / phrase_bank.fs
+            rendered[key] = (i, duration, 0.0)
+            stats["bank_hits"] += 1
+        else:
+            start = time.perf_counter()
+            pcm, fs, service = synthesize_sentence(sentence, spk_id, backend, voc)
+            # 成本与 RTF 统计只用服务耗时：墙钟时间含其他任务的占用，predict_finish 会另外计入；缓存命中不计入
+            if service is not None:
+                cost_model.observe((backend, voc), len(sentence), service)
+                cost_model.observe((backend, voc, spk_id), len(sentence), service)
+            write_atomic(audio_path, lambda temp_path: sf.write(temp_path, pcm, samplerate=fs))
+            duration = len(pcm) / fs
+            rendered[key] = (i, duration, time.perf_counter() - start)
+            if service is None:
+                stats["cache_hits"] += 1
+            else:
+                samples.append((len(sentence), service, duration))
+                stats["synthesized"] += 1
+        source = rendered[key][0]
+        job_store.record_segment(job["job_id"], i, source, duration)
+        merge_sources.append(segment_path(job, source))
+        job["completed"] += 1
+        job["duration"] += duration
+        publish_event("segment-ready", {
+            "job_id": job["job_id"], "name": base_name, "index": i,
+            "url": f"/segments/{job['job_id']}/{os.path.basename(audio_path)}", "duration": round(duration, 3),
+        })
 
     combined_audio_path = os.path.join(files_dir, f"{base_name}.mp3")
-    merge_audio_files(audio_files, combined_audio_path)
+    merge_audio_files(merge_sources, combined_audio_path)
 
-    deletion_queue.extend(audio_files)
+    rtf_estimator.observe_job((backend, voc), spk_id, samples)
+    finish_job(job, "finished", "job-finished", url=f"/files/{base_name}.mp3",
+               duration=round(job["duration"], 3), stats=stats)
 
-@app.route('/generate_audio', methods=['POST'])
-def generate_audio():
-    global stop_flag, current_thread
+def generate_document_task(data, job, document_path):
+    try:
+        run_document_job(data, job, document_path)
+    except Exception as e:
+        print(f"长文档生成失败: {e}")
+        finish_job(job, "failed", "job-failed", error=str(e))
+    finally:
+        os.remove(document_path)
+
+def run_document_job(data, job, document_path):
+    """长文档：边读原文边拆句边合成，PCM 直接送入 mp3 编码器，内存占用与文档长度无关"""
+    base_name = job["name"]
+    spk_id = int(data.get("spk_id", 0))
+    backend = data.get("backend", default_backend)
+    voc = data.get("voc", default_voc)
+    job["split_params"] = choose_split_params((backend, voc), data.get("latency_mode", default_split_mode))
+    fs = worker_pool.fs if worker_pool else tts_manager.get_model(spk_id, backend)[0].fs
+    load_model = frontend_loader(data)
+
+    stats = {"sentences": 0, "synthesized": 0, "reused": 0, "bank_hits": 0, "cache_hits": 0,
+             "saved_chars": 0, "saved_seconds": 0.0}
+    job.update(status="running", stats=stats)
+    publish_event("job-started", {"job_id": job["job_id"], "name": base_name, "segments": None})
+    recent = collections.OrderedDict()  # 最近合成过的归一化句子 -> (PCM, 合成耗时)
+    samples = []  # (字数, 合成耗时, 音频时长)
+
+    def render(temp_path):
+        encoder = Mp3Encoder(temp_path, fs)
+        try:
+            with open(document_path, encoding="utf-8", errors="replace") as f:
+                chunks = iter(lambda: f.read(document_read_size), "")
+                sentences = iter_sentences(chunks, job["split_params"]["max_length"],
+                                           job["split_params"]["first_max_length"])
+                if load_model is not None:
+                    sentences = prefetch_ahead(load_model, sentences, lambda index, sentence: needs_frontend(data, sentence))
+                for sentence in sentences:
+                    if job["cancel_requested"]:
+                        raise JobCancelled()
+                    key = normalize_sentence(sentence)
+                    bank_wav = None
+                    if key not in recent and phrase_bank.fs == fs:
+                        bank_wav = phrase_bank.lookup(sentence, spk_id, backend, voc)
+                    if key in recent:
+                        recent.move_to_end(key)
+                        pcm, cost = recent[key]
+                        stats["reused"] += 1
+                        stats["saved_chars"] += len(sentence)
+                        stats["saved_seconds"] = round(stats["saved_seconds"] + cost, 3)
+                    elif bank_wav is not None:
+                        pcm = to_pcm16(bank_wav)
+                        stats["bank_hits"] += 1
+                    else:
+                        start = time.perf_counter()
+                        audio, _, service = synthesize_sentence(sentence, spk_id, backend, voc)
+                        cost = time.perf_counter() - start
+                        if service is None:
+                            stats["cache_hits"] += 1
+                        else:
+                            cost_model.observe((backend, voc), len(sentence), service)
+                            cost_model.observe((backend, voc, spk_id), len(sentence), service)
+                            samples.append((len(sentence), service, len(audio) / fs))
+                            stats["synthesized"] += 1
+                        pcm = audio.tobytes()
+                        recent[key] = (pcm, cost)
+                        if len(recent) > document_dedup_size:
+                            recent.popitem(last=False)
+                    encoder.write(pcm)
+                    stats["sentences"] += 1
+                    job["completed"] += 1
+                    job["duration"] += len(pcm) / 2 / fs
+        except BaseException:
+            encoder.abort()
+            with contextlib.suppress(FileNotFoundError):  # 第一句之前中断时 ffmpeg 可能还没创建文件
+                os.remove(temp_path)
+            raise
+        encoder.close()
+
+    try:
+        write_atomic(os.path.join(files_dir, f"{base_name}.mp3"), render)
+    except JobCancelled:
+        print("中断长文档生成任务")
+        finish_job(job, "cancelled", "job-cancelled")
+        return
+    job["segments"] = stats["sentences"]
+    rtf_estimator.observe_job((backend, voc), spk_id, samples)
+    finish_job(job, "finished", "job-finished", url=f"/files/{base_name}.mp3",
+               duration=round(job["duration"], 3), stats=stats)
+
+def resume_jobs():
+    """容器重启后恢复未完成的任务，从第一个缺失的片段继续；其余遗留的工作目录直接删除"""
+    unfinished = job_store.unfinished()
+    resumable = {plan["job_id"] for plan, _ in unfinished}
+    for job_id in os.listdir(segments_dir):
+        if job_id not in resumable:
+            schedule_deletion(job_dir(job_id), 0)
+    for plan, progress in unfinished:
+        job = create_job(plan["data"], plan["job_id"])
+        job.update(split_params=plan["split_params"], created_at=plan["created_at"],
+                   estimated_cost=estimate_job(plan["data"], map(len, plan["sentences"]))[0])
+        print(f"恢复任务: {job['name']}（已完成 {len(progress)}/{len(plan['sentences'])}）")
+        threading.Thread(target=run_profiled,
+                         args=(generate_audio_task, plan["data"], job, plan["sentences"], progress)).start()
+
+def invalid_options(data):
+    """校验请求中的推理选项，返回错误响应或 None"""
+    for field in ("name", "text", "template"):
+        if field in data and not isinstance(data[field], str):
+            return jsonify({"error": f"Invalid {field}. Must be a string."}), 400
+    # JSON 中为整数，查询字符串中为数字字符串
+    spk_id = data.get("spk_id", 0)
+    if isinstance(spk_id, bool) or not (isinstance(spk_id, int) and spk_id >= 0 or
+                                        isinstance(spk_id, str) and spk_id.isdecimal()):
+        return jsonify({"error": "Invalid spk_id. Must be a non-negative integer."}), 400
+    if data.get("backend", default_backend) not in backends:
+        return jsonify({"error": f"Invalid backend. Supported: {', '.join(backends)}"}), 400
+    if data.get("voc", default_voc) not in vocoders:
+        return jsonify({"error": f"Invalid voc. Supported: {', '.join(vocoders)}"}), 400
+    if data.get("latency_mode", default_split_mode) not in split_modes:
+        return jsonify({"error": f"Invalid latency_mode. Supported: {', '.join(split_modes)}"}), 400
+    return None
 
-    if current_thread and current_thread.is_alive():
-        return jsonify({"error": "已有一个生成任务正在运行"}), 400
+def estimate_job(data, lengths):
+    """估计任务的 (合成耗时, 音频时长)（秒），lengths 为各句字数
 
-    stop_flag = False
+    优先使用已完成任务的 RTF 统计；没有时退回在线拟合的单次调用开销与单字成本，再没有时用默认值。
+    """
+    model_key = (data.get("backend", default_backend), data.get("voc", default_voc))
+    spk_id = int(data.get("spk_id", 0))
+    fit = cost_model.fit((*model_key, spk_id)) or cost_model.fit(model_key)
+    per_call, per_char = fit[:2] if fit else (default_per_call, default_per_char)
+    cost = duration = 0.0
+    for chars in lengths:
+        predicted = rtf_estimator.predict(model_key, spk_id, chars)
+        if predicted is None:
+            predicted = (per_call + per_char * chars, chars * default_seconds_per_char)
+        cost += predicted[0]
+        duration += predicted[1]
+    return cost, duration
+
+def predict_finish(cost, others):
+    """并发任务共享算力（近似按处理器共享）：耗时 cost 的任务在 others 剩余耗时之外还需要多久完成"""
+    return (cost + sum(min(remaining, cost) for remaining in others)) / worker_capacity
+
+def remaining_cost(job):
+    """任务剩余的估计合成耗时"""
+    if not job["segments"]:
+        return job["estimated_cost"]
+    return job["estimated_cost"] * max(1 - job["completed"] / job["segments"], 0.0)
+
+def busy_response(message, retry_after, **payload):
+    """429 + Retry-After（秒）"""
+    retry_after = max(1, math.ceil(retry_after))
+    response = jsonify({"error": message, "retry_after": retry_after, **payload})
+    response.headers["Retry-After"] = str(retry_after)
+    return response, 429
+
+admission_lock = threading.Lock()
+
+def admission_check(data, cost):
+    """准入控制：按当前负载预计的完成时间超过 latency_budget 时拒绝，返回 None 表示接受"""
+    active = active_jobs()
+    if "name" in data and any(job["name"] == data["name"] for job in active):
+        return jsonify({"error": f"同名任务正在运行: {data['name']}"}), 400
+    remaining = [remaining_cost(job) for job in active]
+    if len(active) >= max_active_jobs:
+        return busy_response(f"已有{len(active)}个生成任务正在运行", min(remaining) / worker_capacity)
+    wait = predict_finish(cost, remaining)
+    if remaining and wait > latency_budget:
+        # 积压降到 latency_budget 以内所需的时间；本任务自身就超出时要等积压清空
+        return busy_response("服务繁忙，预计完成时间超出限制", wait - max(latency_budget, cost / worker_capacity),
+                             estimated_seconds=round(wait, 1))
+    return None
+
+def estimate_response(data, lengths):
+    """预计合成耗时、音频时长和按当前负载的完成时间"""
+    cost, duration = estimate_job(data, lengths)
+    wait = predict_finish(cost, [remaining_cost(job) for job in active_jobs()])
+    return {"sentences": len(lengths), "chars": sum(lengths), "estimated_cost": round(cost, 2),
+            "estimated_duration": round(duration, 2), "estimated_seconds": round(wait, 2),
+            "estimated_finish_at": round(time.time() + wait, 2)}
+
+@app.route('/generate_audio', methods=['POST'])
+def generate_audio():
     data = request.get_json()
     if not data or 'name' not in data or 'text' not in data:
         return jsonify({"error": "Invalid input. 'name' and 'text' fields are required."}), 400
+    error = invalid_options(data)
+    if error:
+        return error
+
+    estimate = estimate_response(data, [len(sentence) for sentence in plan_sentences(data)[1]])
+    with admission_lock:  # 检查与登记之间不能插入其他请求（同名任务、TTS_MAX_JOBS）
+        error = admission_check(data, estimate["estimated_cost"])
+        if error:
+            return error
+        job = create_job(data)
+        job.update(estimated_cost=estimate["estimated_cost"], estimated_duration=estimate["estimated_duration"],
+                   estimated_finish_at=estimate["estimated_finish_at"])
+    threading.Thread(target=run_profiled, args=(generate_audio_task, data, job)).start()
+
+    return jsonify({"message": "音频生成任务已开始", "job_id": job["job_id"], **estimate}), 200
+
+@app.route('/estimate', methods=['POST'])
+def estimate():
+    """只估计、不合成：请求体与 /generate_audio 相同，返回预计耗时、音频时长、完成时间以及是否会被接受
+
+    是否接受与 /generate_audio 使用同一个 admission_check（延迟预算、TTS_MAX_JOBS、同名任务），
+    不接受时 rejection 中给出原因、状态码和 Retry-After。
+    """
+    data = request.get_json()
+    if not data or 'text' not in data:
+        return jsonify({"error": "Invalid input. 'text' field is required."}), 400
+    error = invalid_options(data)
+    if error:
+        return error
+    estimate = estimate_response(data, [len(sentence) for sentence in plan_sentences(data)[1]])
+    error = admission_check(data, estimate["estimated_cost"])
+    if error is None:
+        return jsonify({**estimate, "admitted": True})
+    response, status = error
+    return jsonify({**estimate, "admitted": False, "rejection": {"status": status, **response.get_json()}})
+
+@app.route('/generate_document', methods=['POST'])
+def generate_document():
+    """长文档模式：请求体为 UTF-8 纯文本（可用 chunked 分块上传），其余参数放在查询字符串中"""
+    data = request.args.to_dict()
+    if 'name' not in data:
+        return jsonify({"error": "Invalid input. 'name' query parameter is required."}), 400
+    error = invalid_options(data)
+    if error:
+        return error
+
+    # chunked 上传没有 Content-Length，只能按积压判断；UTF-8 中文约 3 字节一个字
+    chars = (request.content_length or 0) // 3
+    estimate = estimate_response(data, [split_default_length] * (chars // split_default_length))
+    with admission_lock:
+        error = admission_check(data, estimate["estimated_cost"])
+        if error:
+            return error
+        # 原文先按块落盘，生成时再逐块读取，不在内存中保留全文
+        job = create_job(data)
+        job.update(estimated_cost=estimate["estimated_cost"], estimated_duration=estimate["estimated_duration"],
+                   estimated_finish_at=estimate["estimated_finish_at"])
+    document_path = os.path.join(job_dir(job["job_id"]), "document.txt")
+    try:
+        os.makedirs(job_dir(job["job_id"]))
+        with open(document_path, 'wb') as f:
+            shutil.copyfileobj(request.stream, f, document_read_size)
+    except BaseException as e:
+        # 上传中断等：任务已登记，必须结束它，否则一直占着同名和 TTS_MAX_JOBS 的名额
+        finish_job(job, "failed", "job-failed", error=f"上传原文失败: {e}")
+        shutil.rmtree(job_dir(job["job_id"]), ignore_errors=True)
+        raise
+    threading.Thread(target=run_profiled, args=(generate_document_task, data, job, document_path)).start()
+
+    return jsonify({"message": "长文档生成任务已开始", "job_id": job["job_id"]}), 200
+
+def active_jobs():
+    """排队中或运行中的任务"""
+    return [job for job in list(jobs.values()) if job["status"] in ("queued", "running")]
+
+@app.route('/stats', methods=['GET'])
+def stats():
+    """运行统计：批处理 batch 大小与排队+推理延迟直方图、启动耗时"""
+    active = active_jobs()
+    admission = {"backlog_seconds": round(sum(map(remaining_cost, active)) / worker_capacity, 2),
+                 "latency_budget": latency_budget, "capacity": worker_capacity}
+    return jsonify({"active_jobs": len(active), "batching": batch_scheduler.snapshot(),
+                    "admission": admission, "rtf": rtf_estimator.snapshot(), "phrase_bank": phrase_bank.snapshot(),
+                    "segment_cache": segment_cache.snapshot(), "frontend": frontend_pool.snapshot(),
+                    "workers": worker_pool.snapshot() if worker_pool else None, "startup": startup_report})
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    """查询任务状态"""
+    job = jobs.get(job_id)
+    if not job:
+        return jsonify({"error": "Job not found"}), 404
+    if job["status"] in ("queued", "running"):  # 按当前负载更新预计完成时间
+        others = [remaining_cost(other) for other in active_jobs() if other is not job]
+        job["estimated_finish_at"] = round(time.time() + predict_finish(remaining_cost(job), others), 2)
+    return jsonify(job)
+
+def wav_stream_header(fs):
+    """流式 WAV 头（单声道 16bit），数据长度未知时按惯例填最大值"""
+    data_size = 0xFFFFFFFF - 36
+    return struct.pack('<4sI4s4sIHHIIHH4sI', b'RIFF', data_size + 36, b'WAVE', b'fmt ', 16,
+                       1, 1, fs, fs * 2, 2, 16, b'data', data_size)
+
+def to_int16(wav):
+    """float 波形 -> int16 PCM 数组"""
+    return (np.clip(wav, -1.0, 1.0) * 32767).astype('<i2')
+
+def to_pcm16(wav):
+    """float 波形 -> 16bit PCM 字节"""
+    return to_int16(wav).tobytes()
+
+@app.route('/stream_audio', methods=['POST'])
+def stream_audio():
+    """流式合成接口：逐块返回 WAV，第一段音频不必等整句合成完"""
+    data = request.get_json()
+    if not data or 'text' not in data:
+        return jsonify({"error": "Invalid input. 'text' field is required."}), 400
+    error = invalid_options(data)
+    if error:
+        return error
 
-    clear_mp3_files(output_dir)
+    backend, voc = data.get("backend", default_backend), data.get("voc", default_voc)
+    model, speaker_id = tts_manager.get_model(int(data.get("spk_id", 0)), backend)
 
-    current_thread = threading.Thread(target=generate_audio_task, args=(data,))
-    current_thread.start()
+    def generate():
+        start, first = time.time(), True
+        yield wav_stream_header(model.fs)
+        for sentence in split_text_into_sentences(data["text"]):
+            bank_wav = phrase_bank.lookup(sentence, speaker_id, backend, voc) if phrase_bank.fs == model.fs else None
+            chunks = [bank_wav] if bank_wav is not None else model.synthesize_stream(sentence, speaker_id, voc)
+            for chunk in chunks:
+                if first:
+                    print(f"首段音频延迟: {(time.time() - start) * 1000:.0f}ms")
+                    first = False
+                yield to_pcm16(chunk)
 
-    return jsonify({"message": "音频生成任务已开始"}), 200
+    return Response(generate(), mimetype='audio/wav')
 
 @app.route('/stop_audio', methods=['POST'])
 def stop_audio():
-    global stop_flag
-    stop_flag = True
-    return jsonify({"message": "音频生成中断指令已发送"}), 200
+    """中断指定 job_id 的任务；不传 job_id 时中断所有运行中的任务"""
+    data = request.get_json(silent=True) or {}
+    targets = [job for job in active_jobs() if data.get("job_id") in (None, job["job_id"])]
+    for job in targets:
+        job["cancel_requested"] = True
+    return jsonify({"message": "音频生成中断指令已发送", "job_ids": [job["job_id"] for job in targets]}), 200
 
-def split_text_into_sentences(text, max_length=30):
-    """根据标点符号和最大长度拆分文本"""
+def normalize_sentence(sentence):
+    """句子归一化（全角/半角、空白），用于判断任务内的重复句"""
+    sentence = re.sub(r'\s+', ' ', unicodedata.normalize('NFKC', sentence)).strip()
+    return re.sub(r' ?([^\x00-\x7f]) ?', r'\1', sentence)  # 中文字符和标点两侧的空格没有意义
+
+def split_text_into_sentences(text, max_length=30, first_max_length=None):
+    """根据标点符号和最大长度拆分文本，first_max_length 单独限制第一句的长度"""
     punctuation = r'([。！？\.\!\?，,；;])'
     parts = re.split(punctuation, text)
     sentences, temp_sentence = [], ''
+
+    def flush(sentence):
+        """输出一句；只有标点的片段并入上一句（没有上一句时留给下一句），返回留下的部分"""
+        sentence = sentence.strip()
+        if re.search(r'\w', sentence):
+            sentences.append(sentence)
+        elif sentences:
+            sentences[-1] += sentence
+        else:
+            return sentence
+        return ''
+
     for part in parts:
+        limit = first_max_length if first_max_length and not sentences else max_length
         if re.match(punctuation, part):
             temp_sentence += part
-            if len(temp_sentence) >= max_length or part in '。！？.\!?':
-                sentences.append(temp_sentence.strip())
-                temp_sentence = ''
+            if len(temp_sentence) >= limit or part in '。！？.\!?':
+                temp_sentence = flush(temp_sentence)
         else:
             temp_sentence += part
-            if len(temp_sentence) >= max_length:
-                sentences.append(temp_sentence.strip())
-                temp_sentence = ''
-    if temp_sentence.strip():
-        sentences.append(temp_sentence.strip())
+            if len(temp_sentence) >= limit:
+                temp_sentence = flush(temp_sentence)
+    flush(temp_sentence)
     return sentences
 
+def iter_sentences(chunks, max_length=30, first_max_length=None):
+    """增量拆句：chunks 为文本块迭代器，遇到句末标点就输出之前的句子，只在内存中保留未成句的尾部"""
+    buffer, count = '', 0
+    for chunk in chunks:
+        buffer += chunk
+        end = max(buffer.rfind(p) for p in '。！？.!?') + 1
+        if end:
+            sentences = split_text_into_sentences(buffer[:end], max_length, None if count else first_max_length)
+            buffer = buffer[end:]
+        elif len(buffer) >= document_flush_length:  # 长时间没有句末标点，最后一段可能未完，留到下一块
+            sentences = split_text_into_sentences(buffer, max_length, None if count else first_max_length)
+            buffer = sentences.pop() if sentences else buffer
+        else:
+            continue
+        count += len(sentences)
+        yield from sentences
+    if buffer.strip():
+        yield from split_text_into_sentences(buffer, max_length, None if count else first_max_length)
+
 def merge_audio_files(input_files, output_file):
-    """合并多个音频文件"""
-    combined = AudioSegment.empty()
-    for file in input_files:
-        audio_segment = AudioSegment.from_mp3(file)
-        combined += audio_segment
-    combined.export(output_file, format="mp3")
+    """合并多个音频文件：逐个解码后送入 mp3 编码器，只缓存重复出现的文件"""
+    AudioSegment = lazy_import("pydub").AudioSegment
+    counts = collections.Counter(input_files)
+    decoded = {}
+
+    def merge(temp_path):
+        encoder = None
+        try:
+            for file in input_files:
+                segment = decoded.get(file) or AudioSegment.from_mp3(file).set_sample_width(2)
+                if counts[file] > 1:
+                    decoded[file] = segment
+                if encoder is None:
+                    encoder = Mp3Encoder(temp_path, segment.frame_rate, segment.channels)
+                encoder.write(segment.raw_data)
+            encoder = encoder or Mp3Encoder(temp_path, 24000)
+        except BaseException:
+            if encoder:
+                encoder.abort()
+            raise
+        encoder.close()
+    write_atomic(output_file, merge)
+
+@app.route('/health', methods=['GET'])
+def health():
+    """健康检查（协调节点据此判断 worker 是否可用）"""
+    return jsonify({"status": "ok", "models": list(tts_manager.models), "active_jobs": len(active_jobs())})
+
+@app.route('/worker/synthesize', methods=['POST'])
+def worker_synthesize():
+    """worker 接口：合成一句（先查短语库和共享缓存），返回 16bit PCM，采样率见响应头 X-Sample-Rate"""
+    data = request.get_json()
+    if not data or 'text' not in data:
+        return jsonify({"error": "Invalid input. 'text' field is required."}), 400
+    error = invalid_options(data)
+    if error:
+        return error
+    spk_id, backend, voc = int(data.get("spk_id", 0)), data.get("backend", default_backend), data.get("voc", default_voc)
+    pcm, fs, service = phrase_bank.lookup_pcm(data["text"], spk_id, backend, voc), phrase_bank.fs, None
+    if pcm is None:
+        pcm, fs, service = synthesize_local(data["text"], spk_id, backend, voc)
+    headers = {"X-Sample-Rate": str(fs), "X-Cache": "miss" if service is not None else "hit"}
+    if service is not None:
+        headers["X-Service-Time"] = f"{service:.6f}"  # 供协调节点的成本估计使用
+    return Response(pcm.tobytes(), mimetype='application/octet-stream', headers=headers)
+
+@app.route('/templates', methods=['POST'])
+def register_template():
+    """注册播报模板：{"name": "call", "template": "请{号码}号到{窗口}窗口办理", "spk_id": 0}，固定部分在这里渲染"""
+    data = request.get_json()
+    if not data or 'name' not in data or 'template' not in data:
+        return jsonify({"error": "Invalid input. 'name' and 'template' fields are required."}), 400
+    error = invalid_options(data)
+    if error:
+        return error
+    start = time.perf_counter()
+    definition = template_store.register(data["name"], data["template"], int(data.get("spk_id", 0)),
+                                         data.get("voc", default_voc), data.get("backend", default_backend))
+    return jsonify({"name": data["name"], **definition,
+                    "render_ms": round((time.perf_counter() - start) * 1000, 1)}), 200
+
+@app.route('/templates', methods=['GET'])
+def list_templates():
+    return jsonify(template_store.templates)
+
+@app.route('/templates/<name>', methods=['DELETE'])
+def delete_template(name):
+    if not template_store.remove(name):
+        return jsonify({"error": "Template not found"}), 404
+    return jsonify({"message": f"已删除模板: {name}"}), 200
+
+@app.route('/announce', methods=['POST'])
+def announce():
+    """模板播报：{"template": "call", "slots": {"号码": "15", "窗口": "3"}, "name": "call"}
+
+    只合成槽位并拼接，作为只有一个片段的任务发布（segment-ready / job-finished 事件、/files/<name>.mp3）。
+    """
+    data = request.get_json()
+    if not data or 'template' not in data:
+        return jsonify({"error": "Invalid input. 'template' field is required."}), 400
+    error = invalid_options(data)
+    if error:
+        return error
+    if data["template"] not in template_store.templates:
+        return jsonify({"error": f"Template not found: {data['template']}"}), 404
+    definition = template_store.templates[data["template"]]
+    slots = data.get("slots") or {}
+    missing = [slot for slot in definition["slots"] if slot not in slots]
+    if missing:
+        return jsonify({"error": f"Missing slot: {missing[0]}"}), 400
+
+    # 与其他任务走同一个准入控制（同名任务、TTS_MAX_JOBS、延迟预算），成本按槽位字数估计
+    job_data = {"name": data.get("name", data["template"]), "spk_id": definition["spk_id"],
+                "backend": definition["backend"], "voc": definition["voc"]}
+    cost, _ = estimate_job(job_data, [len(str(slots[slot])) for slot in definition["slots"]])
+    with admission_lock:
+        error = admission_check(job_data, cost)
+        if error:
+            return error
+        job = create_job({"name": job_data["name"]})
+    start = time.perf_counter()
+    try:
+        wav, fs, synthesized = template_store.render(data["template"], slots)
+    except Exception as e:
+        finish_job(job, "failed", "job-failed", error=str(e))
+        raise
+
+    os.makedirs(job_dir(job["job_id"]))
+    audio_path = segment_path(job, 0)
+    write_atomic(audio_path, lambda temp_path: sf.write(temp_path, wav, samplerate=fs))
+    duration = round(len(wav) / fs, 3)
+    job.update(status="running", segments=1, completed=1, duration=duration)
+    publish_event("job-started", {"job_id": job["job_id"], "name": job["name"], "segments": 1})
+    publish_event("segment-ready", {
+        "job_id": job["job_id"], "name": job["name"], "index": 0,
+        "url": f"/segments/{job['job_id']}/{os.path.basename(audio_path)}", "duration": duration,
+    })
+    write_atomic(os.path.join(files_dir, f"{job['name']}.mp3"),
+                 lambda temp_path: shutil.copyfile(audio_path, temp_path))
+    elapsed_ms = round((time.perf_counter() - start) * 1000, 1)
+    finish_job(job, "finished", "job-finished", url=f"/files/{job['name']}.mp3", duration=duration,
+               stats={"synthesized_slots": synthesized, "elapsed_ms": elapsed_ms})
+    return jsonify({"job_id": job["job_id"], "url": job["url"], "duration": duration,
+                    "synthesized_slots": synthesized, "elapsed_ms": elapsed_ms}), 200
+
+def admin_required(view):
+    """管理接口鉴权：请求头 X-Admin-Token 需与环境变量 TTS_ADMIN_TOKEN 一致"""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        if not admin_token:
+            return jsonify({"error": "管理接口未启用，请设置环境变量 TTS_ADMIN_TOKEN"}), 403
+        if not hmac.compare_digest(request.headers.get("X-Admin-Token", ""), admin_token):
+            return jsonify({"error": "Unauthorized"}), 401
+        return view(*args, **kwargs)
+    return wrapper
+
+@app.route('/admin/profile', methods=['POST'])
+@admin_required
+def start_profile():
+    """开始性能分析：{"jobs": N} 覆盖接下来 N 个任务，或 {"seconds": T} 覆盖 T 秒内开始的任务"""
+    data = request.get_json() or {}
+    jobs_count, seconds = data.get("jobs"), data.get("seconds")
+    mode = data.get("mode", "both")
+    if not jobs_count and not seconds:
+        return jsonify({"error": "Invalid input. 'jobs' or 'seconds' is required."}), 400
+    if mode not in ProfileSession.modes:
+        return jsonify({"error": f"Unsupported mode: {mode}, choose from {list(ProfileSession.modes)}"}), 400
+    if current_profile():
+        return jsonify({"error": "已有性能分析正在进行", **current_profile().snapshot()}), 409
+    session = ProfileSession(int(jobs_count) if jobs_count else None, float(seconds) if seconds else None,
+                             mode, float(data.get("interval_ms", 10)) / 1000)
+    profile_sessions.append(session)
+    del profile_sessions[:-20]
+    return jsonify(session.snapshot()), 200
+
+@app.route('/admin/profile', methods=['GET'])
+@admin_required
+def list_profiles():
+    """最近的性能分析会话及下载地址"""
+    return jsonify([session.snapshot() for session in profile_sessions])
+
+@app.route('/admin/profile/<session_id>/<kind>', methods=['GET'])
+@admin_required
+def download_profile(session_id, kind):
+    """下载分析结果：pstats（python -m pstats / snakeviz）或 collapsed（flamegraph.pl / speedscope）"""
+    if kind not in ("pstats", "collapsed"):
+        return jsonify({"error": "Not found"}), 404
+    return send_from_directory(profiles_dir, f"{session_id}.{kind}", as_attachment=True)
 
 @app.route('/files/<path:filename>', methods=['GET'])
 def download_file(filename):
     """提供下载接口"""
     return send_from_directory(files_dir, filename)
 
+@app.route('/segments/<job_id>/<filename>', methods=['GET'])
+def download_segment(job_id, filename):
+    """单句片段下载接口（只提供 .mp3，供 HTTP 模式的播放端拉取）"""
+    if not filename.endswith(".mp3"):
+        return jsonify({"error": "Not found"}), 404
+    return send_from_directory(segments_dir, f"{job_id}/{filename}")
+
+@app.route('/events', methods=['GET'])
+def events():
+    """SSE 事件流：job-started / segment-ready / job-finished / job-cancelled / job-failed"""
+    subscriber = queue.Queue(maxsize=1000)
+    with event_lock:
+        event_subscribers.append(subscriber)
+
+    def stream():
+        try:
+            yield ": connected\n\n"
+            while True:
+                try:
+                    yield subscriber.get(timeout=15)
+                except queue.Empty:
+                    if subscriber not in event_subscribers:
+                        break
+                    yield ": keepalive\n\n"
+        finally:
+            with event_lock:
+                if subscriber in event_subscribers:
+                    event_subscribers.remove(subscriber)
+
+    return Response(stream(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+def export_onnx(model_dir=onnx_dir, opset=11):
+    """把 fastspeech2_aishell3 / hifigan_aishell3 导出为 ONNX，只需执行一次"""
+    from pathlib import Path
+    from paddlespeech.t2s.exps.syn_utils import am_to_static, voc_to_static
+
+    executor = tts_manager.get_model(0, 'paddle')[0].executor
+    static_dir = Path(model_dir) / 'static'
+    static_dir.mkdir(parents=True, exist_ok=True)
+    am_to_static(am_inference=executor.am_inference, am='fastspeech2_aishell3',
+                 inference_dir=static_dir, speaker_dict=speaker_dict_path)
+    voc_to_static(voc_inference=executor.voc_inference, voc='hifigan_aishell3',
+                  inference_dir=static_dir)
+    for name in ('fastspeech2_aishell3', 'hifigan_aishell3'):
+        onnx_path = os.path.join(model_dir, f'{name}.onnx')
+        subprocess.run([
+            'paddle2onnx', '--model_dir', str(static_dir),
+            '--model_filename', f'{name}.pdmodel', '--params_filename', f'{name}.pdiparams',
+            '--save_file', onnx_path, '--opset_version', str(opset), '--enable_onnx_checker', 'True',
+        ], check=True)
+        print(f"已导出: {onnx_path}")
+
+def build_phrase_bank(phrases_path, speakers, vocs, backend=default_backend, path=phrase_bank_path):
+    """离线渲染短语库：每个 speaker、每个声码器把短语表渲染一遍，PCM 依次写入一个文件并生成索引"""
+    with open(phrases_path, encoding="utf-8") as f:
+        phrases = [line.strip() for line in f if line.strip() and not line.startswith("#")]
+    entries, offset, fs = [], 0, TTSBackend.fs
+
+    def write_pcm(temp_path):
+        nonlocal offset, fs
+        with open(temp_path, "wb") as out:
+            for spk_id in speakers:
+                model, speaker_id = tts_manager.get_model(spk_id, backend)
+                fs = model.fs
+                for voc in vocs:
+                    for phrase in phrases:
+                        pcm = to_pcm16(model.synthesize(phrase, speaker_id, voc))
+                        out.write(pcm)
+                        entries.append([voc, spk_id, PhraseBank.key(phrase), offset, len(pcm) // 2])
+                        offset += len(pcm) // 2
+            print(f"已渲染 {len(entries)} 条短语，共 {offset / fs:.1f} 秒")
+
+    def write_index(temp_path):
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump({"fs": fs, "backend": backend, "entries": entries}, f, ensure_ascii=False)
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    write_atomic(f"{path}.pcm", write_pcm)
+    write_atomic(f"{path}.json", write_index)
+    print(f"短语库已写入: {path}.pcm / {path}.json（重启服务后生效）")
+
+def quantize_vocoder(mode='dynamic', model_dir=onnx_dir, spk_id=0):
+    """把 hifigan_aishell3.onnx 量化为 INT8（dynamic：只量化权重；static：用 bench_texts 的 mel 校准激活）"""
+    from onnxruntime.quantization import (CalibrationDataReader, QuantFormat, QuantType,
+                                          quantize_dynamic, quantize_static)
+
+    float_path = os.path.join(model_dir, 'hifigan_aishell3.onnx')
+    int8_path = os.path.join(model_dir, 'hifigan_aishell3_int8.onnx')
+    if mode == 'dynamic':
+        quantize_dynamic(float_path, int8_path, weight_type=QuantType.QInt8)
+    else:
+        model, _ = tts_manager.get_model(spk_id)
+        mels = [model.acoustic(ids, spk_id) for text in bench_texts for ids in model.get_phone_ids(text)]
+        input_name = OnnxVocoder(float_path).input
+
+        class MelReader(CalibrationDataReader):
+            def __init__(self):
+                self.feeds = iter([{input_name: mel.astype(np.float32)} for mel in mels])
+
+            def get_next(self):
+                return next(self.feeds, None)
+
+        quantize_static(float_path, int8_path, MelReader(), quant_format=QuantFormat.QDQ,
+                        activation_type=QuantType.QUInt8, weight_type=QuantType.QInt8, per_channel=True)
+    print(f"已生成量化声码器（{mode}）: {int8_path}")
+
+bench_texts = [
+    "请1号到3号窗口办理业务。",
+    "您好，欢迎光临，请取号后在等候区稍候。",
+    "今天是2024年12月31日，本大厅将于下午5点30分停止办理业务，请各位办事群众合理安排时间。",
+]
+
+def snr_db(reference, signal):
+    """以 reference 为基准的信噪比（dB），长度不一致时按较短的对齐"""
+    n = min(len(reference), len(signal))
+    noise = np.sum((reference[:n] - signal[:n]) ** 2)
+    return float('inf') if noise == 0 else float(10 * np.log10(np.sum(reference[:n] ** 2) / noise))
+
+def log_spectral_distance(reference, signal, n_fft=1024, hop=256):
+    """对数功率谱距离（dB），对相位不敏感，比 SNR 更能反映 GAN 声码器的听感差异"""
+    def log_power(wav):
+        frames = np.lib.stride_tricks.sliding_window_view(wav, n_fft)[::hop] * np.hanning(n_fft)
+        return 10 * np.log10(np.abs(np.fft.rfft(frames, axis=-1)) ** 2 + 1e-10)
+    n = min(len(reference), len(signal))
+    if n < n_fft:
+        return 0.0
+    diff = log_power(reference[:n]) - log_power(signal[:n])
+    return float(np.mean(np.sqrt(np.mean(diff ** 2, axis=-1))))
+
+def bench_vocoders(texts=bench_texts, spk_id=0, repeat=5, report_path=None):
+    """声码器质量/速度对比：以 float hifigan_aishell3 的 ONNX 模型为基准，生成 markdown 报告
+
+    基准固定用 ONNX Runtime 跑 float 模型，INT8 的加速比只反映量化本身，不混入 paddle 与 ONNX Runtime 的差异；
+    当前后端不是 onnx 时另列一行它自带的声码器，仅供参考。
+    """
+    model, _ = tts_manager.get_model(spk_id)
+    mels = [model.acoustic(ids, spk_id) for text in texts for ids in model.get_phone_ids(text)]
+    candidates = [(f"{voc} (onnx)", OnnxVocoder(os.path.join(onnx_dir, f'{voc}.onnx'))) for voc in vocoders]
+    if model.name != 'onnx':
+        candidates.append((f"hifigan_aishell3 ({model.name}，仅供参考)", lambda mel: model.vocode(mel, 'hifigan_aishell3')))
+    references = [candidates[0][1](mel) for mel in mels]
+    audio_seconds = sum(len(wav) for wav in references) / model.fs
+
+    lines = [
+        f"# 声码器质量 / 速度报告（声学模型后端 {model.name}，{len(mels)} 句，共 {audio_seconds:.1f}s 音频，CPU 线程 {cpu_threads}）",
+        "",
+        "| 声码器 | 耗时(s) | RTF | 加速比 | SNR(dB) | 对数谱距离(dB) |",
+        "| --- | --- | --- | --- | --- | --- |",
+    ]
+    baseline = None
+    for name, vocode in candidates:
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            wavs = [vocode(mel) for mel in mels]
+            timings.append(time.perf_counter() - start)
+        elapsed = sorted(timings)[len(timings) // 2]
+        baseline = baseline or elapsed
+        snr = np.mean([snr_db(ref, wav) for ref, wav in zip(references, wavs)])
+        lsd = np.mean([log_spectral_distance(ref, wav) for ref, wav in zip(references, wavs)])
+        lines.append(f"| {name} | {elapsed:.3f} | {elapsed / audio_seconds:.3f} | "
+                     f"{baseline / elapsed:.2f}x | {snr:.1f} | {lsd:.2f} |")
+    report = "\n".join(lines) + "\n"
+    print(report)
+    if report_path:
+        with open(report_path, 'w', encoding='utf-8') as f:
+            f.write(report)
+        print(f"报告已写入: {report_path}")
+    return report
+
+def bench_backends(texts=bench_texts, spk_id=0, repeat=5):
+    """对比 paddle 与 onnx 后端：逐阶段数值一致性 + 端到端耗时"""
+    models = {name: tts_manager.get_model(spk_id, name)[0] for name in ('paddle', 'onnx')}
+    reference = models['paddle']
+
+    print("== 一致性（以 paddle 为基准）==")
+    for text in texts:
+        for ids in reference.get_phone_ids(text):
+            mel_ref = reference.acoustic(ids, spk_id)
+            mel = models['onnx'].acoustic(ids, spk_id)
+            n = min(len(mel_ref), len(mel))
+            mel_err = float(np.abs(mel_ref[:n] - mel[:n]).max())
+            wav_snr = snr_db(reference.vocode(mel_ref, 'hifigan_aishell3'),
+                             models['onnx'].vocode(mel_ref, 'hifigan_aishell3'))
+            print(f"{text[:16]:<16} 帧数 {len(mel_ref)}/{len(mel)}  mel最大误差 {mel_err:.4f}  声码器SNR {wav_snr:.1f}dB")
+
+    print(f"== 速度（{repeat} 次取中位数，RTF = 合成耗时 / 音频时长）==")
+    results = {}
+    for name, model in models.items():
+        for text in texts:
+            timings = []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                wav = model.synthesize(text, spk_id, 'hifigan_aishell3')
+                timings.append(time.perf_counter() - start)
+            elapsed = sorted(timings)[len(timings) // 2]
+            rtf = elapsed / (len(wav) / model.fs)
+            results[(name, text)] = (elapsed, rtf)
+            print(f"{name:<6} {len(text):>3}字  {elapsed * 1000:8.1f}ms  RTF {rtf:.3f}")
+    return results
+
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=8888)
+    parser = argparse.ArgumentParser(description="汉鑫 TTS 服务")
+    subparsers = parser.add_subparsers(dest='command')
+    parser.set_defaults(port=8888, worker=False, workers=os.environ.get("TTS_WORKERS"))
+    serve_parser = subparsers.add_parser('serve', help="启动 HTTP 服务（默认）")
+    serve_parser.add_argument('--port', type=int, default=8888)
+    serve_parser.add_argument('--worker', action='store_true', help="只作为 worker 提供 /worker/synthesize，不恢复任务")
+    serve_parser.add_argument('--workers', default=os.environ.get("TTS_WORKERS"),
+                              help="协调模式：worker 地址，逗号分隔（如 http://127.0.0.1:8891,http://127.0.0.1:8892）")
+    export_parser = subparsers.add_parser('export-onnx', help="导出 ONNX 模型")
+    export_parser.add_argument('--output', default=onnx_dir)
+    export_parser.add_argument('--opset', type=int, default=11)
+    bench_parser = subparsers.add_parser('bench', help="paddle / onnx 一致性与速度对比")
+    bench_parser.add_argument('--text', action='append', help="测试文本，可重复指定")
+    bench_parser.add_argument('--spk-id', type=int, default=0)
+    bench_parser.add_argument('--repeat', type=int, default=5)
+    quantize_parser = subparsers.add_parser('quantize-voc', help="生成 INT8 量化声码器")
+    quantize_parser.add_argument('--mode', choices=('dynamic', 'static'), default='dynamic')
+    quantize_parser.add_argument('--output', default=onnx_dir)
+    subparsers.add_parser('startup-report', help="启动耗时报告（导入/模型加载/预热）")
+    phrases_parser = subparsers.add_parser('build-phrases', help="离线渲染预渲染短语库")
+    phrases_parser.add_argument('phrases', help="短语表，每行一条，# 开头为注释")
+    phrases_parser.add_argument('--spk-id', type=int, action='append', help="speaker，可重复指定（默认 0）")
+    phrases_parser.add_argument('--voc', action='append', choices=vocoders, help="声码器，可重复指定（默认 TTS_VOC）")
+    phrases_parser.add_argument('--backend', choices=backends, default=default_backend)
+    phrases_parser.add_argument('--output', default=phrase_bank_path)
+    bench_voc_parser = subparsers.add_parser('bench-voc', help="声码器质量/速度报告")
+    bench_voc_parser.add_argument('--text', action='append', help="测试文本，可重复指定")
+    bench_voc_parser.add_argument('--spk-id', type=int, default=0)
+    bench_voc_parser.add_argument('--repeat', type=int, default=5)
+    bench_voc_parser.add_argument('--report', default=os.path.join(onnx_dir, 'voc_report.md'))
+    args = parser.parse_args()
+
+    if args.command == 'export-onnx':
+        export_onnx(args.output, args.opset)
+    elif args.command == 'bench':
+        bench_backends(args.text or bench_texts, args.spk_id, args.repeat)
+    elif args.command == 'quantize-voc':
+        quantize_vocoder(args.mode, args.output)
+    elif args.command == 'bench-voc':
+        bench_vocoders(args.text or bench_texts, args.spk_id, args.repeat, args.report)
+    elif args.command == 'build-phrases':
+        build_phrase_bank(args.phrases, args.spk_id or [0], args.voc or [default_voc], args.backend, args.output)
+    elif args.command == 'startup-report':
+        startup_report["ready"] = since_startup()
+        tts_manager.get_model(0)  # 无预加载时模型在这里加载，相当于第一个请求的等待时间
+        print(json.dumps(startup_report, ensure_ascii=False, indent=2))
+    else:
+        if args.workers:
+            urls = [url for url in args.workers.split(',') if url.strip()]
+            worker_pool = WorkerPool(urls)
+            worker_capacity *= len(urls)  # 准入控制按 worker 数放大算力
+            print(f"协调模式，worker: {', '.join(urls)}")
+        startup_report["ready"] = since_startup()
+        print(f"启动报告: {json.dumps(startup_report, ensure_ascii=False)}")
+        if not args.worker:  # worker 与协调节点共用 /mnt 时不能清理协调节点的任务目录
+            resume_jobs()
+        app.run(host='0.0.0.0', port=args.port, threaded=True)